@@ -0,0 +1,282 @@
+"""
+Latency, throughput and SQL query counts of the main endpoints at several
+data scales, with the view cache on and off.
+
+Each scale is seeded once with `DataGenerator` into an SQLite file under
+--data-dir and reused by later runs with the same seed. Requests go through
+the Flask test client, so the numbers exclude the network and the WSGI
+server.
+
+Usage:
+    python -m benchmarks.endpoints --scales 1000,100000,1000000 --output results.json
+    python -m benchmarks.endpoints --scales 1000 --baseline results.json --threshold 0.2
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from sqlalchemy import event
+from config import TestConfig
+from webapp import create_app, db
+from webapp.admin import admin
+from webapp.api import rest_api
+from webapp.auth.models import Role, User, followers
+from webapp.blog.models import Post, Comment, Tag
+from webapp.cli import fake_roles
+from webapp.testdata import DataGenerator
+
+# Distinct URLs requested per endpoint, in rotation
+TARGETS = 20
+
+
+def dataset(posts):
+    """
+    The shape of the dataset seeded for a number of posts.
+    """
+    users = max(20, posts // 100)
+    return {
+        'users': users,
+        'posts': posts,
+        'tags': max(10, posts // 2000),
+        'comments': posts * 2,
+        'follows': users * 20,
+    }
+
+
+def make_config(path, cached):
+    class BenchmarkConfig(TestConfig):
+        DEBUG = False
+        SECRET_KEY = TestConfig.SECRET_KEY or 'benchmark'
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+        CACHE_TYPE = 'SimpleCache' if cached else 'NullCache'
+        CACHE_THRESHOLD = 100000
+    return BenchmarkConfig
+
+
+def make_app(path, cached):
+    # Flask-Admin and Flask-RESTful keep their views on module singletons
+    admin._views = [admin.index_view]
+    rest_api.resources = []
+    return create_app(make_config(path, cached))
+
+
+def seed(path, posts, seed, workers):
+    """
+    Create and fill the database of one scale, unless a previous run did.
+    """
+    if os.path.exists(path):
+        return
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+    app = make_app(path + '.tmp', cached=False)
+    with app.app_context():
+        db.create_all()
+        for name in fake_roles:
+            db.session.add(Role(name))
+        db.session.commit()
+        DataGenerator(seed=seed, workers=workers, echo=print, **dataset(posts)).run()
+        db.engine.dispose()
+    os.rename(path + '.tmp', path)
+
+
+def targets(rng):
+    """
+    Pick the URLs of every endpoint, and the user to sign in as.
+
+    Returns:
+    - tuple: The username following the most users, and a dict of URL lists
+      keyed by endpoint.
+    """
+    def sample(column):
+        count = db.session.execute(db.select(db.func.count(column))).scalar()
+        offsets = sorted(rng.sample(range(count), min(TARGETS, count)))
+        return [db.session.execute(db.select(column).order_by(column).offset(offset).limit(1)).scalar()
+                for offset in offsets]
+
+    post_ids = sample(Post.id)
+    comment_ids = sample(Comment.id)
+    tags = sample(Tag.title)
+    authors = db.session.execute(
+        db.select(User.username).join(Post).group_by(User.id).order_by(db.func.count(Post.id).desc()).limit(TARGETS)
+    ).scalars().all()
+    reader = db.session.execute(
+        db.select(User.username).join(followers, followers.c.follower_id == User.id)
+        .group_by(User.id).order_by(db.func.count().desc()).limit(1)
+    ).scalar()
+    return reader, {
+        'blog.home': ['/blog/?page=%d' % page for page in range(1, 6)],
+        'blog.post': ['/blog/post/%d' % id for id in post_ids],
+        'blog.posts_by_tag': ['/blog/tag/%s' % title for title in tags],
+        'blog.posts_by_user': ['/blog/user/%s' % username for username in authors],
+        'blog.followed_posts': ['/blog/followed_posts?page=%d' % page for page in range(1, 6)],
+        'api.post': ['/api/post/%d' % id for id in post_ids],
+        'api.post_list': ['/api/post?page=%d' % page for page in range(1, 6)],
+        'api.comment': ['/api/comment/%d' % id for id in comment_ids],
+        'api.post_comments': ['/api/post/%d/comments' % id for id in post_ids],
+    }
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    return values[min(len(values) - 1, max(0, int(round(q / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def measure(client, urls, requests, warmup, headers, queries):
+    """
+    Request `urls` in rotation and summarize the timings.
+
+    Returns:
+    - dict: Latency percentiles in ms, requests per second, SQL statements
+      per request and the number of non-200 responses.
+    """
+    for i in range(warmup):
+        client.get(urls[i % len(urls)], headers=headers)
+    latencies = []
+    counts = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(requests):
+        before = queries[0]
+        start = time.perf_counter()
+        response = client.get(urls[i % len(urls)], headers=headers)
+        latencies.append((time.perf_counter() - start) * 1000)
+        counts.append(queries[0] - before)
+        if response.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'rps': round(requests / elapsed, 1),
+        'queries_mean': round(sum(counts) / len(counts), 2),
+        'queries_max': max(counts),
+    }
+
+
+def run_scale(path, cached, requests, warmup, rng, only=None):
+    """
+    Benchmark every endpoint against one seeded database.
+
+    Returns:
+    - dict: The summary of each endpoint, see `measure`.
+    """
+    app = make_app(path, cached)
+    results = {}
+    with app.app_context():
+        queries = [0]
+
+        def count(*args):
+            queries[0] += 1
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            reader, urls = targets(rng)
+            anonymous = app.test_client()
+            member = app.test_client()
+            member.post('/auth/login', data={'username': reader, 'password': 'password'})
+            response = anonymous.post('/auth/api', json={'username': reader, 'password': 'password'})
+            token = {'Authorization': 'Bearer %s' % response.get_json()['access_token']}
+            for endpoint, endpoint_urls in urls.items():
+                if only and endpoint not in only:
+                    continue
+                client = member if endpoint == 'blog.followed_posts' else anonymous
+                headers = token if endpoint.startswith('api.') else None
+                results[endpoint] = measure(client, endpoint_urls, requests, warmup, headers, queries)
+                print('  %-22s cache=%-3s p50 %8.2fms  p99 %8.2fms  %7.1f req/s  %5.1f queries' % (
+                    endpoint, 'on' if cached else 'off', results[endpoint]['p50_ms'],
+                    results[endpoint]['p99_ms'], results[endpoint]['rps'], results[endpoint]['queries_mean']
+                ))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+            db.session.remove()
+            db.engine.dispose()
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """
+    Compare p50 latency and query counts against a previous run.
+
+    Returns:
+    - list: A description of every endpoint that got slower by more than
+      `threshold` (a fraction) or runs more queries.
+    """
+    found = []
+    for scale, modes in results['results'].items():
+        for mode, endpoints in modes.items():
+            for endpoint, current in endpoints.items():
+                previous = baseline.get('results', {}).get(scale, {}).get(mode, {}).get(endpoint)
+                if previous is None:
+                    continue
+                name = '%s posts, cache %s, %s' % (scale, mode, endpoint)
+                if current['p50_ms'] > previous['p50_ms'] * (1 + threshold):
+                    found.append('%s: p50 %.2fms -> %.2fms' % (name, previous['p50_ms'], current['p50_ms']))
+                if current['queries_mean'] > previous['queries_mean']:
+                    found.append('%s: %.2f -> %.2f queries' % (name, previous['queries_mean'], current['queries_mean']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,100000,1000000', help='Comma separated numbers of posts')
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per endpoint')
+    parser.add_argument('--endpoints', help='Comma separated endpoints to run, all by default')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the datasets and of the sampled URLs')
+    parser.add_argument('--workers', type=int, help='Processes seeding the datasets')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir(), help='Where the seeded databases are kept')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='A previous --output to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Tolerated p50 slowdown against the baseline')
+    args = parser.parse_args()
+    only = set(args.endpoints.split(',')) if args.endpoints else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        path = os.path.join(args.data_dir, 'blog-bench-%d-%d.db' % (scale, args.seed))
+        seed(path, scale, args.seed, args.workers)
+        print('%d posts' % scale)
+        results['results'][str(scale)] = {
+            mode: run_scale(path, mode == 'on', args.requests, args.warmup, random.Random(args.seed), only)
+            for mode in ('off', 'on')
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if baseline is not None:
+        found = regressions(results, baseline, args.threshold)
+        for line in found:
+            print('REGRESSION %s' % line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of flask_restful.marshal against the compiled serializers.
+
+Usage:
+    python -m benchmarks.serializers --posts 1000 --repeat 20
+"""
+import argparse
+import datetime
+import json
+import timeit
+from flask_restful import marshal
+from webapp import create_app, db
+from webapp.blog.models import Post, Comment, Tag
+from webapp.api.blog.controllers import post_fields, comment_fields, post_serializer, comment_serializer
+
+
+def make_rows(n):
+    tags = [Tag('tag%d' % i) for i in range(5)]
+    for i, tag in enumerate(tags):
+        tag.id = i + 1
+    posts = []
+    comments = []
+    for i in range(n):
+        post = Post('Post %d' % i)
+        post.id = i + 1
+        post.user_id = 1
+        post.text = '<p>Body of post <b>%d</b></p>' % i
+        post.publish_date = datetime.datetime(2023, 1, 1) + datetime.timedelta(minutes=i)
+        post.tags = tags[:i % 3 + 1]
+        posts.append(post)
+        comment = Comment()
+        comment.id = i + 1
+        comment.post_id = post.id
+        comment.user_id = 1
+        comment.name = 'user'
+        comment.text = 'Comment %d' % i
+        comment.date = post.publish_date
+        comments.append(comment)
+    return posts, comments
+
+
+def run(n, repeat):
+    posts, comments = make_rows(n)
+    results = {}
+    for name, rows, fields, serializer in (
+        ('posts', posts, post_fields, post_serializer),
+        ('comments', comments, comment_fields, comment_serializer),
+    ):
+        baseline = json.dumps(marshal(rows, fields))
+        compiled = json.dumps(serializer.serialize(rows))
+        assert baseline == compiled, '%s output differs' % name
+        marshal_time = min(timeit.repeat(lambda: json.dumps(marshal(rows, fields)), number=1, repeat=repeat))
+        compiled_time = min(timeit.repeat(lambda: json.dumps(serializer.serialize(rows)), number=1, repeat=repeat))
+        results[name] = {
+            'rows': n,
+            'marshal_ms': round(marshal_time * 1000, 3),
+            'compiled_ms': round(compiled_time * 1000, 3),
+            'speedup': round(marshal_time / compiled_time, 2),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=1000, help='Rows serialized per run')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per variant, the fastest is kept')
+    args = parser.parse_args()
+
+    app = create_app('config.TestConfig')
+    with app.app_context():
+        db.create_all()
+        print(json.dumps(run(args.posts, args.repeat), indent=4))
+
+
+if __name__ == '__main__':
+    main()
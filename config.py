@@ -3,6 +3,7 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config(object):
     POSTS_PER_PAGE = 10
+    USERS_PER_PAGE = 20
     SECRET_KEY = os.environ.get('SECRET_KEY')
     RECAPTCHA_PUBLIC_KEY = os.environ.get('RECAPTCHA_PUBLIC_KEY')
     RECAPTCHA_PRIVATE_KEY = os.environ.get('RECAPTCHA_PRIVATE_KEY')
@@ -13,13 +14,62 @@ class Config(object):
     GITHUB_CLIENT_ID = os.environ.get('GITHUB_CLIENT_ID')
     GITHUB_CLIENT_SECRET = os.environ.get('GITHUB_CLIENT_SECRET')
     BOOTSTRAP_BOOTSWATCH_THEME = 'journal'
+    # Bump to orphan every cached page at once, e.g. after a template change
+    CACHE_NAMESPACE_VERSION = os.environ.get('CACHE_NAMESPACE_VERSION', '1')
+    # Authors with more followers than this are merged into feeds on read
+    # instead of being copied into every follower's timeline
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 1000))
+    # Seconds before a process rereads the roles table
+    ROLE_REGISTRY_TTL = 300
+    # Seconds the logged in user's id, username and roles are served from cache
+    USER_CACHE_TIMEOUT = 60
+    # last_seen is recorded at most once a minute per user and written in
+    # batches by a background thread
+    LAST_SEEN_THROTTLE = 60
+    LAST_SEEN_FLUSH_INTERVAL = 30
+    # bcrypt cost; hashes stored with another cost are rehashed on login
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    # Threads hashing passwords, and how many checks may wait for one
+    BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 4))
+    BCRYPT_QUEUE_LIMIT = int(os.environ.get('BCRYPT_QUEUE_LIMIT', 64))
+    # Count and time SQL, cache and template work of every request, report it
+    # in a Server-Timing header and a JSON log line, and warn about statements
+    # repeated this many times in one request (probable N+1 lazy loads)
+    REQUEST_INSTRUMENTATION = True
+    SERVER_TIMING = True
+    N_PLUS_ONE_THRESHOLD = 5
+    # /metrics counts requests, SQL and cache use whether or not
+    # REQUEST_INSTRUMENTATION is on: it starts the same per-request accounting
+    # itself when the instrumentation is off.
+    # /metrics sums the files every worker process keeps in this directory;
+    # unset, it only covers the process answering. Clear it on server start.
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    # Required as a bearer token by /metrics when set
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # gzip (and brotli, if the brotli package is installed) for text responses
+    # of at least COMPRESS_MIN_SIZE bytes, as the client's Accept-Encoding allows
+    COMPRESS = True
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+    COMPRESS_LEVEL = 6
+    COMPRESS_BR_LEVEL = 5
+    COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                          'application/javascript']
+    # POST /api/post/bulk: posts accepted per request and per transaction
+    API_BULK_MAX_ITEMS = 50000
+    API_BULK_BATCH_SIZE = 1000
 
 class ProdConfig(Config):
     SECRET_KEY = os.environ.get('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'database.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    CACHE_TYPE = 'SimpleCache'
+    # Shared by every worker process so they all read and invalidate the same keys.
+    # Redis (requires the redis package) when CACHE_REDIS_URL is set, else a cache directory on the host.
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    CACHE_TYPE = 'RedisCache' if CACHE_REDIS_URL else 'FileSystemCache'
+    CACHE_DIR = os.environ.get('CACHE_DIR') or os.path.join(basedir, 'cache')
+    CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD', 10000))
+    CACHE_KEY_PREFIX = 'webapp/'
 
 class DevConfig(Config):
     DEBUG = True
@@ -37,4 +87,7 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     CACHE_TYPE = 'null'
-    WTF_CSRF_ENABLED = False
\ No newline at end of file
+    WTF_CSRF_ENABLED = False
+    # Tests flush the last_seen buffer explicitly
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    BCRYPT_LOG_ROUNDS = 4
\ No newline at end of file
@@ -1,19 +1,40 @@
 import unittest
 import json
-from webapp import create_app, db
-from webapp.auth.models import User, Role
+import datetime
+from flask_restful import marshal
+from webapp import create_app, db, cache
+from config import TestConfig
+from webapp.auth.models import User, Role, role_registry
+from webapp.auth.cached_user import load_cached_user
+from webapp.auth.last_seen import last_seen
+from webapp.auth.passwords import password_hasher, hash_rounds
+from webapp.auth import bcrypt
+from webapp.blog.models import Tag, Post, Comment, resolve_tags, add_tags_to_post
+from webapp.api.blog.controllers import post_fields, comment_fields, post_serializer, comment_serializer
+from webapp.blog.search import search_posts
+from webapp.export import export_lines
+from webapp.testdata import DataGenerator
+from webapp.instrumentation import statement_shape
+from webapp.metrics import metrics, ValueFile, FILE_PATTERN
+from webapp.explain import explain_hot_queries, full_scans
 from webapp.admin import admin
 from webapp.api import rest_api
 import re
+import gzip
+import os
+import tempfile
+from sqlalchemy import event
+from flask_jwt_extended import get_jwt, verify_jwt_in_request
 
 class TestURLs(unittest.TestCase):
     def setUp(self):
-        admin._views = []
+        admin._views = [admin.index_view]
         rest_api.resources = []
 
         app = create_app('config.TestConfig')
         self.app_context = app.app_context()
         self.app_context.push()
+        self.app = app
         self.client = app.test_client()
         db.app = app
         db.create_all()
@@ -122,5 +143,681 @@ class TestURLs(unittest.TestCase):
         result = self.client.post('api/post', headers=headers, data='{"title":"Text Title","text":"Changed"}')
         self.assertEqual(result.status_code, 201)
 
+    def test_tag_post_count(self):
+        """Test Tag.post_count follows post_tags changes"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        result = self.client.post('api/post', headers=headers, data='{"title":"One","text":"One","tags":["a","b"]}')
+        first_id = json.loads(result.data)['id']
+        self.client.post('api/post', headers=headers, data='{"title":"Two","text":"Two","tags":["a"]}')
+        counts = {tag.title: tag.post_count for tag in Tag.query.all()}
+        self.assertEqual(counts, {'a': 2, 'b': 1})
+
+        result = self.client.delete('api/post/%d' % first_id, headers=headers)
+        self.assertEqual(result.status_code, 204)
+        db.session.expire_all()
+        counts = {tag.title: tag.post_count for tag in Tag.query.all()}
+        self.assertEqual(counts, {'a': 1, 'b': 0})
+
+    def test_cache_invalidation(self):
+        """Test cached post pages are evicted when a comment is added"""
+        cache.init_app(self.app, config={'CACHE_TYPE': 'SimpleCache'})
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        result = self.client.post('api/post', headers=headers, data='{"title":"Cached","text":"Body","tags":["a"]}')
+        post_id = json.loads(result.data)['id']
+
+        self.client.get('/blog/post/%d' % post_id)
+        result = self.client.get('/blog/post/%d' % post_id)
+        self.assertNotIn(b'Fresh comment', result.data)
+        result = self.client.post('api/post/%d/comments' % post_id, headers=headers,
+                                  data='{"name":"test","text":"Fresh comment"}')
+        self.assertEqual(result.status_code, 201)
+        result = self.client.get('/blog/post/%d' % post_id)
+        self.assertIn(b'Fresh comment', result.data)
+
+        self.assertIn(b'Cached', self.client.get('/blog/tag/a').data)
+        self.client.delete('api/post/%d' % post_id, headers=headers)
+        self.assertNotIn(b'Cached', self.client.get('/blog/tag/a').data)
+
+    def test_api_cursor_pagination(self):
+        """Test walking the post feed with cursors"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        for i in range(25):
+            self.client.post('api/post', headers=headers, data='{"title":"Post %d","text":"Text"}' % i)
+
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            result = self.client.get('api/post?cursor=%s' % cursor, headers=headers)
+            self.assertEqual(result.status_code, 200)
+            data = json.loads(result.data)
+            ids.extend(item['id'] for item in data['items'])
+            cursor = data['next_cursor']
+        self.assertEqual(ids, list(range(25, 0, -1)))
+
+        # Undated posts follow the dated ones, across page boundaries
+        db.session.execute(Post.__table__.update().where(Post.id.between(3, 15)).values(publish_date=None))
+        db.session.commit()
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            result = self.client.get('api/post?cursor=%s' % cursor, headers=headers)
+            self.assertEqual(result.status_code, 200)
+            data = json.loads(result.data)
+            ids.extend(item['id'] for item in data['items'])
+            cursor = data['next_cursor']
+        self.assertEqual(ids, list(range(25, 15, -1)) + [2, 1] + list(range(15, 2, -1)))
+
+        result = self.client.get('api/post?cursor=garbage', headers=headers)
+        self.assertEqual(result.status_code, 400)
+
+    def test_hot_queries_use_indexes(self):
+        """Test no hot query plan scans a whole table"""
+        for name, plan in explain_hot_queries().items():
+            self.assertEqual(full_scans(plan), [], name)
+
+    def test_search(self):
+        """Test full-text search stays in sync with post writes"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        result = self.client.post('api/post', headers=headers, data='{"title":"Zebra","text":"Stripes everywhere"}')
+        post_id = json.loads(result.data)['id']
+        self.client.post('api/post', headers=headers, data='{"title":"Other","text":"Nothing to see"}')
+
+        result = self.client.get('/blog/search?q=stripes')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'<mark>Stripes</mark>', result.data)
+
+        result = self.client.get('api/search?q=zebra', headers=headers)
+        data = json.loads(result.data)
+        self.assertEqual([item['id'] for item in data['items']], [post_id])
+
+        self.client.put('api/post/%d' % post_id, headers=headers, data='{"title":"Horse"}')
+        data = json.loads(self.client.get('api/search?q=zebra', headers=headers).data)
+        self.assertEqual(data['total'], 0)
+        self.client.delete('api/post/%d' % post_id, headers=headers)
+        data = json.loads(self.client.get('api/search?q=stripes', headers=headers).data)
+        self.assertEqual(data['total'], 0)
+        self.assertEqual(self.client.get('api/search?q=%22', headers=headers).status_code, 200)
+
+    def test_post_render_artifacts(self):
+        """Test post bodies are sanitized and excerpted on write"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        body = '<p>Hello <b>world</b><script>alert(1)</script> <a href=\\"javascript:x\\">link</a></p>' + ' word' * 200
+        result = self.client.post('api/post', headers=headers, data='{"title":"Render","text":"%s"}' % body)
+        post_id = json.loads(result.data)['id']
+
+        result = self.client.get('/blog/post/%d' % post_id)
+        self.assertIn(b'<p>Hello <b>world</b> <a>link</a>', result.data)
+        self.assertNotIn(b'alert(1)', result.data)
+
+        post = db.session.get(Post, post_id)
+        self.assertTrue(post.excerpt.startswith('Hello worldalert(1) link word'))
+        self.assertLessEqual(len(post.excerpt), 500)
+        result = self.client.get('api/post/%d' % post_id, headers=headers)
+        self.assertEqual(json.loads(result.data)['text'], post.text_plain)
+
+        # Rows written before the render columns existed are rendered on read
+        db.session.execute(Post.__table__.update().values(text_html=None, text_plain=None, excerpt=None))
+        db.session.commit()
+        self.assertIn(b'Hello worldalert(1) link word', self.client.get('/blog/').data)
+        result = self.client.get('/blog/post/%d' % post_id)
+        self.assertIn(b'<p>Hello <b>world</b> <a>link</a>', result.data)
+        self.assertNotIn(b'None', result.data)
+        result = self.client.get('api/post/%d' % post_id, headers=headers)
+        self.assertTrue(json.loads(result.data)['text'].startswith('Hello worldalert(1) link'))
+
+    def test_compiled_serializers_match_marshal(self):
+        """Test the compiled API serializers encode exactly like marshal"""
+        post = Post('Title')
+        post.id = 1
+        post.text = '<p>Body</p>'
+        post.publish_date = datetime.datetime(2023, 5, 1, 12, 30)
+        post.tags = [Tag('one'), Tag('two')]
+        empty = Post()
+        comment = Comment()
+        comment.text = 'Text'
+        for data, fields, serializer in (
+            ([post, empty], post_fields, post_serializer),
+            (post, post_fields, post_serializer),
+            ([comment, Comment()], comment_fields, comment_serializer),
+            ({'id': '3', 'title': 'dict'}, post_fields, post_serializer),
+        ):
+            self.assertEqual(json.dumps(serializer.serialize(data)), json.dumps(marshal(data, fields)))
+
+    def test_timeline_fan_out(self):
+        """Test followed_posts reads the timeline and falls back for popular authors"""
+        self._insert_user('author', 'test', 'default')
+        reader = User('reader')
+        db.session.add(reader)
+        db.session.commit()
+        author = User.query.filter_by(username='author').one()
+
+        old = Post('Old')
+        old.user_id = author.id
+        old.publish_date = datetime.datetime(2023, 1, 1)
+        db.session.add(old)
+        db.session.commit()
+        reader.follow(author)
+        db.session.commit()
+        new = Post('New')
+        new.user_id = author.id
+        new.publish_date = datetime.datetime(2023, 1, 2)
+        db.session.add(new)
+        db.session.commit()
+        self.assertEqual([post.title for post in reader.followed_posts()], ['New', 'Old'])
+        self.assertEqual([post.title for post in author.followed_posts()], ['New', 'Old'])
+
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        popular = Post('Popular')
+        popular.user_id = author.id
+        popular.publish_date = datetime.datetime(2023, 1, 3)
+        db.session.add(popular)
+        db.session.commit()
+        self.assertEqual([post.title for post in reader.followed_posts()], ['Popular', 'New', 'Old'])
+
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1000
+        draft = Post('Draft')
+        draft.user_id = author.id
+        db.session.add(draft)
+        db.session.commit()
+        self.assertNotIn('Draft', [post.title for post in reader.followed_posts()])
+        draft.publish_date = datetime.datetime(2023, 1, 4)
+        db.session.commit()
+        self.assertEqual([post.title for post in reader.followed_posts()][0], 'Draft')
+        draft.user_id = reader.id
+        db.session.commit()
+        self.assertNotIn('Draft', [post.title for post in author.followed_posts()])
+        self.assertEqual([post.title for post in reader.followed_posts()][0], 'Draft')
+        draft.publish_date = None
+        db.session.commit()
+        self.assertNotIn('Draft', [post.title for post in reader.followed_posts()])
+        db.session.delete(draft)
+        db.session.commit()
+
+        reader.unfollow(author)
+        db.session.commit()
+        self.assertEqual(reader.followed_posts().all(), [])
+        self.assertEqual(author.follower_count, 0)
+
+    def test_user_profiles_pagination(self):
+        """Test user profiles are paginated with a constant number of queries"""
+        self._insert_user('test', 'test', 'default')
+        for i in range(6):
+            db.session.add(User('user%d' % i))
+        db.session.commit()
+        me = User.query.filter_by(username='test').one()
+        me.follow(User.query.filter_by(username='user0').one())
+        db.session.commit()
+        self.assertEqual(me.following_ids(), {User.query.filter_by(username='user0').one().id})
+        self.client.post('/auth/login', data=dict(username='test', password='test'))
+        self.client.get('/auth/user_profiles')
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            query_counts = []
+            for per_page in (2, 6):
+                self.app.config['USERS_PER_PAGE'] = per_page
+                del statements[:]
+                result = self.client.get('/auth/user_profiles')
+                query_counts.append(len(statements))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertIn(b'Unfollow', result.data)
+
+        self.app.config['USERS_PER_PAGE'] = 2
+        result = self.client.get('/auth/user_profiles?page=2')
+        self.assertIn(b'user1', result.data)
+        self.assertNotIn(b'User: user0', result.data)
+
+    def test_role_names(self):
+        """Test role names are resolved once and carried in the JWT"""
+        self._insert_user('test', 'test', 'default')
+        user = User.query.filter_by(username='test').one()
+        self.assertEqual(user.role_names, frozenset(['default']))
+        poster = Role('poster')
+        user.roles.append(poster)
+        self.assertTrue(user.has_role('poster'))
+        self.assertFalse(user.has_role('admin'))
+        db.session.commit()
+
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        with self.app.test_request_context(headers={'Authorization': 'Bearer %s' % access_token}):
+            verify_jwt_in_request()
+            self.assertEqual(get_jwt()['roles'], ['default', 'poster'])
+
+    def test_role_registry(self):
+        """Test roles are resolved from the registry without queries"""
+        self._insert_user('test', 'test', 'default')
+        self.assertEqual(role_registry['default'].id, Role.query.filter_by(name='default').one().id)
+        self.assertIsNone(role_registry.get('missing'))
+        db.session.add(Role('poster'))
+        db.session.commit()
+        self.assertEqual(role_registry['poster'].name, 'poster')
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            users = [User('user%d' % i) for i in range(3)]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+        db.session.add_all(users)
+        db.session.commit()
+        self.assertEqual(users[0].role_names, frozenset(['default']))
+
+    def test_cached_user_loader(self):
+        """Test the user loader serves a cached snapshot until the user changes"""
+        cache.init_app(self.app, config={'CACHE_TYPE': 'SimpleCache'})
+        self._insert_user('test', 'test', 'default')
+        user = User.query.filter_by(username='test').one()
+        load_cached_user(user.id)
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            cached = load_cached_user(str(user.id))
+            self.assertEqual(cached.username, 'test')
+            self.assertTrue(cached.has_role('default'))
+            self.assertEqual(cached, user)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+
+        cached.about_me = 'About'
+        cached.username = 'renamed'
+        db.session.commit()
+        self.assertEqual(load_cached_user(user.id).username, 'renamed')
+        self.assertEqual(load_cached_user(user.id).about_me, 'About')
+        self.assertIsNone(load_cached_user('nobody'))
+
+        role = Role.query.filter_by(name='default').one()
+        role.name = 'editor'
+        db.session.commit()
+        self.assertEqual(load_cached_user(user.id).role_names, frozenset(['editor']))
+        db.session.delete(role)
+        db.session.commit()
+        self.assertEqual(load_cached_user(user.id).role_names, frozenset())
+
+    def test_last_seen_write_behind(self):
+        """Test last_seen is buffered, throttled and written in one batch"""
+        self._insert_user('test', 'test', 'default')
+        user = User.query.filter_by(username='test').one()
+        user.last_seen = datetime.datetime(2020, 1, 1)
+        db.session.commit()
+        self.client.post('/auth/login', data=dict(username='test', password='test'))
+        last_seen.flush()
+
+        self.client.get('/blog/')
+        self.assertFalse(last_seen.touch(user.id))
+        self.assertEqual(last_seen.flush(), 1)
+        self.assertEqual(last_seen.flush(), 0)
+        db.session.expire_all()
+        self.assertGreater(user.last_seen, datetime.datetime(2020, 1, 1))
+
+    def test_login_rehash_and_busy(self):
+        """Test logins rehash outdated passwords and fail fast when bcrypt is saturated"""
+        self._insert_user('test', 'test', 'default')
+        user = User.query.filter_by(username='test').one()
+        user.password = bcrypt.generate_password_hash('test', 5)
+        db.session.commit()
+        completed = password_hasher.metrics()['completed']
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        self.assertEqual(result.status_code, 200)
+        db.session.expire_all()
+        self.assertEqual(hash_rounds(user.password), 4)
+        self.assertEqual(password_hasher.metrics()['completed'], completed + 2)
+
+        self.app.config['BCRYPT_QUEUE_LIMIT'] = 0
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        self.assertEqual(result.status_code, 503)
+
+    def test_bulk_tag_resolution(self):
+        """Test tags are resolved with a fixed number of statements"""
+        db.session.add(Tag('existing'))
+        db.session.commit()
+
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            query_counts = []
+            for n in (2, 20):
+                del statements[:]
+                titles = ['existing'] + ['tag%d-%d' % (n, i) for i in range(n)] + ['existing']
+                tags = resolve_tags(titles)
+                query_counts.append(len(statements))
+                self.assertEqual([tag.title for tag in tags], titles[:-1])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        post = Post('Tagged')
+        add_tags_to_post(post, ['existing', 'new', 'existing'])
+        db.session.add(post)
+        db.session.commit()
+        add_tags_to_post(post, ['new', 'other'])
+        db.session.commit()
+        self.assertEqual(sorted(tag.title for tag in post.tags), ['existing', 'new', 'other'])
+        self.assertEqual(Tag.query.filter_by(title='new').one().post_count, 1)
+
+    def test_api_bulk_post(self):
+        """Test bulk post creation from JSON arrays and NDJSON"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+
+        body = json.dumps([
+            {'title': 'One', 'text': '<b>One</b> searchable', 'tags': ['a', 'b', 'a']},
+            {'title': 'Two', 'text': 'Two', 'tags': ['a']},
+            {'text': 'No title'},
+        ])
+        result = self.client.post('api/post/bulk', headers=headers, data=body)
+        self.assertEqual(result.status_code, 207)
+        data = json.loads(result.data)
+        self.assertEqual((data['created'], data['failed']), (2, 1))
+        self.assertEqual(data['items'][2]['error'], {'title': 'Title required'})
+
+        post = db.session.get(Post, data['items'][0]['id'])
+        self.assertEqual(post.text_plain, 'One searchable')
+        self.assertEqual(sorted(tag.title for tag in post.tags), ['a', 'b'])
+        counts = {tag.title: tag.post_count for tag in Tag.query.all()}
+        self.assertEqual(counts, {'a': 2, 'b': 1})
+        user = User.query.filter_by(username='test').one()
+        self.assertEqual(sorted(post.title for post in user.followed_posts()), ['One', 'Two'])
+        self.assertEqual(search_posts('searchable').total, 1)
+
+        headers['content-type'] = 'application/x-ndjson'
+        result = self.client.post('api/post/bulk', headers=headers, data='{"title":"Three","text":"Three"}\nnot json\n')
+        data = json.loads(result.data)
+        self.assertIn('id', data['items'][0])
+        self.assertIn('not valid JSON', data['items'][1]['error'])
+
+    def test_export(self):
+        """Test the NDJSON export streams every row, optionally gzipped"""
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        access_token = json.loads(result.data)['access_token']
+        headers['Authorization'] = "Bearer %s" % access_token
+        self.client.post('api/post/bulk', headers=headers, data=json.dumps([
+            {'title': 'Post %d' % i, 'text': 'Text', 'tags': ['a']} for i in range(5)
+        ]))
+
+        result = self.client.get('api/export/posts', headers={'Authorization': headers['Authorization']})
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in result.data.decode('utf-8').splitlines()]
+        self.assertEqual([line['title'] for line in lines], ['Post %d' % i for i in range(5)])
+        self.assertEqual(lines[0]['tags'][0]['title'], 'a')
+
+        result = self.client.get('api/export/posts', headers={
+            'Authorization': headers['Authorization'], 'Accept-Encoding': 'gzip'
+        })
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(result.data).splitlines()), 5)
+
+        users = [json.loads(line) for line in export_lines('users')]
+        self.assertEqual(users[0]['username'], 'test')
+        self.assertNotIn('password', users[0])
+
+    def test_generate_test_data(self):
+        """Test the batched generator keeps derived data consistent and is reproducible"""
+        db.session.add(Role('default'))
+        db.session.commit()
+        counts = DataGenerator(users=20, posts=1500, tags=4, comments=60, follows=40, seed=1, workers=1, batch=500).run()
+        self.assertEqual(counts['posts'], 1500)
+        self.assertEqual(Post.query.count(), 1500)
+        self.assertEqual(Comment.query.count(), 60)
+        self.assertEqual(sum(tag.post_count for tag in Tag.query), 1500 * 2)
+        post = Post.query.first()
+        self.assertTrue(post.text_html and post.text_plain and post.excerpt)
+        user = User.query.filter(User.follower_count > 0).first()
+        self.assertEqual(user.follower_count, user.followers.count())
+        follower = user.followers.first()
+        authors = [follower.id] + [followed.id for followed in follower.followed]
+        self.assertEqual(follower.followed_posts().count(), Post.query.filter(Post.user_id.in_(authors)).count())
+        self.assertTrue(user.has_role('default'))
+        self.assertFalse(Comment.query.join(Post).filter(Comment.date < Post.publish_date).count())
+        titles = [(post.title, post.publish_date) for post in Post.query.order_by(Post.id)]
+        dates = [comment.date for comment in Comment.query.order_by(Comment.id)]
+
+        db.drop_all()
+        db.create_all()
+        db.session.add(Role('default'))
+        db.session.commit()
+        role_registry.load()
+        DataGenerator(users=20, posts=1500, tags=4, comments=60, follows=40, seed=1, workers=1, batch=500).run()
+        self.assertEqual([(post.title, post.publish_date) for post in Post.query.order_by(Post.id)], titles)
+        self.assertEqual([comment.date for comment in Comment.query.order_by(Comment.id)], dates)
+
+    def test_request_instrumentation(self):
+        """Test the Server-Timing header, the request log line and N+1 detection"""
+        def lazy_tags():
+            return ','.join(tag.title for post in Post.query.all() for tag in post.tags)
+        self.app.add_url_rule('/lazy-tags', 'lazy_tags', lazy_tags)
+        self._insert_user('test', 'test', 'default')
+        headers = {'content-type':'application/json'}
+        result = self.client.post('/auth/api', headers=headers,data='{"username":"test","password":"test"}')
+        headers['Authorization'] = "Bearer %s" % json.loads(result.data)['access_token']
+        self.client.post('api/post/bulk', headers=headers, data=json.dumps([
+            {'title': 'Post %d' % i, 'text': 'Text', 'tags': ['a']} for i in range(6)
+        ]))
+
+        result = self.client.get('/blog/')
+        timing = result.headers['Server-Timing']
+        self.assertRegex(timing, r'sql;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('tpl;dur=', timing)
+
+        with self.assertLogs('webapp.instrumentation', 'WARNING') as logs:
+            self.client.get('/lazy-tags')
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line['endpoint'], 'lazy_tags')
+        self.assertEqual(line['n_plus_one'][0]['count'], 6)
+        self.assertIn('post_tags', line['n_plus_one'][0]['statement'])
+
+        # The post list loads the tags of the whole page at once
+        with self.assertLogs('webapp.instrumentation', 'INFO') as logs:
+            result = self.client.get('api/post', headers={'Authorization': headers['Authorization']})
+        self.assertEqual(len(result.get_json()[0]['tags']), 1)
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line['endpoint'], line['n_plus_one']), ('postapi', []))
+
+        self.assertEqual(
+            statement_shape('SELECT * FROM tag WHERE tag.id IN (?, ?, ?)'),
+            statement_shape('SELECT * FROM tag WHERE tag.id IN (?)')
+        )
+
+    def test_metrics(self):
+        """Test /metrics counts requests and cache use and sums every process' file"""
+        def sample(text, line):
+            match = re.search('^%s (\\S+)$' % re.escape(line), text, re.M)
+            return float(match.group(1)) if match else 0.0
+
+        series = 'flask_http_requests_total{endpoint="blog.home",method="GET",status="200"}'
+        before = sample(self.client.get('/metrics').data.decode('utf-8'), series)
+        self.client.get('/blog/')
+        self.client.get('/blog/')
+        result = self.client.get('/metrics')
+        self.assertTrue(result.mimetype.startswith('text/plain'))
+        text = result.data.decode('utf-8')
+        self.assertEqual(sample(text, series) - before, 2)
+        self.assertIn('flask_http_request_duration_seconds_bucket{endpoint="blog.home",le="+Inf"}', text)
+        self.assertIn('flask_cache_operations_total{prefix="sidebar_data",result="miss"}', text)
+        self.assertEqual(sample(text, 'flask_http_requests_in_flight'), 1)
+
+        directory = tempfile.mkdtemp()
+        # No process can have a pid above the kernel's maximum
+        dead = ValueFile(os.path.join(directory, FILE_PATTERN % (2 ** 22 + 1)))
+        dead.inc(('flask_http_requests_total', 'blog.home', 'GET', '200'), 3)
+        dead.set(('flask_http_requests_in_flight',), 7)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        previous = metrics.directory, metrics.files.pop(os.getpid())
+        metrics.directory = directory
+        try:
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            text = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).data.decode('utf-8')
+        finally:
+            metrics.directory, metrics.files[os.getpid()] = previous
+        self.assertEqual(sample(text, series), 3)
+        # Gauges of processes that are gone are dropped
+        self.assertEqual(sample(text, 'flask_http_requests_in_flight'), 1)
+
+        class Uninstrumented(TestConfig):
+            REQUEST_INSTRUMENTATION = False
+            CACHE_TYPE = 'SimpleCache'
+        admin._views = [admin.index_view]
+        rest_api.resources = []
+        app = create_app(Uninstrumented)
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            before = sample(client.get('/metrics').data.decode('utf-8'), series)
+            result = client.get('/blog/')
+            self.assertNotIn('Server-Timing', result.headers)
+            text = client.get('/metrics').data.decode('utf-8')
+            db.session.remove()
+        self.assertEqual(sample(text, series) - before, 1)
+        self.assertGreater(sample(text, 'flask_sql_queries_total{endpoint="blog.home"}'), 0)
+        self.assertIn('flask_cache_operations_total{prefix="blog.home",result="miss"}', text)
+
+    def test_conditional_get(self):
+        """Test ETags follow Post.updated_at and matching requests get a 304"""
+        self._insert_user('test', 'test', 'default')
+        post = Post('Cached')
+        post.text = 'Body'
+        post.user_id = 1
+        post.publish_date = datetime.datetime.utcnow()
+        add_tags_to_post(post, ['a'])
+        db.session.add(post)
+        db.session.commit()
+        stamp = post.updated_at
+        self.assertIsNotNone(stamp)
+
+        for url in ('/blog/post/1', '/blog/tag/a', '/blog/user/test'):
+            result = self.client.get(url)
+            etag = result.headers['ETag']
+            result = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(result.status_code, 304, url)
+            self.assertEqual(result.data, b'')
+
+        comment = Comment()
+        comment.name = 'test'
+        comment.text = 'Nice'
+        comment.post_id = 1
+        db.session.add(comment)
+        db.session.commit()
+        self.assertGreater(post.updated_at, stamp)
+        stamp = post.updated_at
+        result = self.client.get('/blog/post/1', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+
+        db.session.get(Tag, 1).title = 'b'
+        db.session.commit()
+        self.assertGreater(post.updated_at, stamp)
+
+        result = self.client.post('/auth/api', json={'username': 'test', 'password': 'test'})
+        headers = {'Authorization': 'Bearer %s' % result.get_json()['access_token']}
+        for url in ('/api/post/1', '/api/post'):
+            result = self.client.get(url, headers=headers)
+            self.assertEqual(result.status_code, 200)
+            modified = dict(headers, **{'If-Modified-Since': result.headers['Last-Modified']})
+            self.assertEqual(self.client.get(url, headers=modified).status_code, 304, url)
+        self.assertNotIn('ETag', self.client.get('/api/post?cursor=', headers=headers).headers)
+
+    def test_compression(self):
+        """Test gzip negotiation, the minimum size and precompressed cached pages"""
+        cache.init_app(self.app, config={'CACHE_TYPE': 'SimpleCache'})
+        cache.clear()
+        self._insert_user('test', 'test', 'default')
+        post = Post('Compressed')
+        post.text = 'Body ' * 200
+        post.user_id = 1
+        post.publish_date = datetime.datetime.utcnow()
+        db.session.add(post)
+        db.session.commit()
+
+        plain = self.client.get('/blog/post/1')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        headers = {'Accept-Encoding': 'gzip;q=1, identity;q=0.5'}
+        result = self.client.get('/blog/post/1', headers=headers)
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(result.data), plain.data)
+        self.assertTrue(result.headers['ETag'].endswith('-gzip"'))
+        variants = [key for key in cache.cache._cache if key.startswith('compressed/gzip/blog.post/')]
+        self.assertEqual(len(variants), 1)
+        cache.set(variants[0], b'precompressed')
+        self.assertEqual(self.client.get('/blog/post/1', headers=headers).data, b'precompressed')
+        etag = result.headers['ETag']
+        result = self.client.get('/blog/post/1', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.headers['ETag'], etag)
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        # The gzip copy is no match for a client that does not accept gzip
+        identity = {'Accept-Encoding': 'identity', 'If-None-Match': etag}
+        result = self.client.get('/blog/post/1', headers=identity)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn('Content-Encoding', result.headers)
+        result = self.client.get('/blog/post/1', headers=dict(identity, **{'If-None-Match': result.headers['ETag']}))
+        self.assertEqual(result.status_code, 304)
+        self.assertFalse(result.headers['ETag'].endswith('-gzip"'))
+
+        self.app.config['COMPRESS_MIN_SIZE'] = 10 ** 6
+        self.assertNotIn('Content-Encoding', self.client.get('/blog/', headers=headers).headers)
+
+    def test_admin_performance_dashboard(self):
+        """Test the admin dashboard shows endpoints, cache ratios, statements and plans"""
+        self._insert_user('admin', 'admin', 'default')
+        db.session.add(Role('admin'))
+        db.session.commit()
+        user = User.query.filter_by(username='admin').first()
+        user.roles.append(role_registry['admin'])
+        db.session.commit()
+        self.client.post('/auth/login', data=dict(username='admin', password='admin'))
+        self.client.get('/blog/')
+
+        result = self.client.get('/admin/customview/')
+        self.assertEqual(result.status_code, 200)
+        for text in (b'blog.home', b'sidebar_data', b'Role registry', b'post_tags'):
+            self.assertIn(text, result.data)
+
+        result = self.client.get('/admin/customview/queries')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'FROM post', result.data)
+        self.assertIn(b'followed_posts', result.data)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -21,6 +21,16 @@ debug_toolbar = DebugToolbarExtension()
 cache = Cache()
 moment = Moment()
 
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Keep migration autogenerate away from the full-text search tables.
+
+    The FTS5 table and its shadow tables are created by DDL events rather than
+    declared models, so autogenerate would otherwise try to drop them.
+    """
+    from .blog.search import FTS_TABLE
+    return not (type_ == 'table' and reflected and compare_to is None and name.startswith(FTS_TABLE))
+
 def create_app(object_name):
     """
     Create and configure a Flask application.
@@ -43,9 +53,17 @@ def create_app(object_name):
     app.config.from_object(object_name)
     bootstrap = Bootstrap4(app)
     cache.init_app(app)
+    # Registered first so its timing wraps the other request hooks
+    from .instrumentation import instrumentation
+    instrumentation.init_app(app)
+    from .metrics import metrics
+    metrics.init_app(app)
+    # after_request hooks run in reverse order, so the timing above includes compression
+    from .compression import compression
+    compression.init_app(app)
 
     db.init_app(app)
-    migrate.init_app(app, db, render_as_batch=True)
+    migrate.init_app(app, db, render_as_batch=True, include_object=include_object)
     debug_toolbar.init_app(app)
     moment.init_app(app)
 
@@ -1,6 +1,6 @@
 from flask_admin import Admin
 from .. import db
-from .controllers import CustomModelView, CustomView
+from .controllers import CustomModelView, CustomView, RoleModelView
 from webapp.blog.models import Post, Comment, Tag
 from webapp.auth.models import User, Role
 import os.path as op
@@ -9,11 +9,12 @@ admin = Admin()
 
 def create_module(app, **kwargs):
     admin.init_app(app)
-    admin.add_view(CustomView(name='Custom'))
+    admin.add_view(CustomView(name='Performance'))
 
     models = [User, Role, Comment, Tag, Post]
-
+    # Role edits must refresh the in-process role registry
+    views = {Role: RoleModelView}
 
     for model in models:
-        admin.add_view(CustomModelView(model, db.session, category='Models'))
+        admin.add_view(views.get(model, CustomModelView)(model, db.session, category='Models'))
     
\ No newline at end of file
@@ -4,21 +4,47 @@ from flask_admin.contrib.fileadmin import FileAdmin
 from flask_login import login_required, current_user
 
 from webapp.auth import has_role
+from webapp.auth.models import role_registry
+from webapp.metrics import metrics
+from webapp.instrumentation import statement_totals
+from . import dashboard
 
 class CustomView(BaseView):
+    """
+    Performance dashboard, fed from the in-process metrics so it stays cheap
+    to load while the site is struggling.
+    """
     @expose('/')
     @login_required
     @has_role('admin')
     def index(self):
-        return self.render('admin/custom.html')
-    
-    @expose('/second_page')
+        values = metrics.collect()
+        return self.render(
+            'admin/custom.html',
+            endpoints=dashboard.endpoint_summary(values),
+            caches=dashboard.cache_summary(values),
+            memory=dashboard.in_process_caches(),
+            tables=dashboard.table_counts()
+        )
+
+    @expose('/queries')
     @login_required
     @has_role('admin')
-    def second_page(self):
-        return self.render('admin/second_page.html')
+    def queries(self):
+        return self.render(
+            'admin/queries.html',
+            statements=statement_totals.top(25),
+            plans=dashboard.index_usage()
+        )
     
 class CustomModelView(ModelView):
     def is_accessible(self):
         return current_user.is_authenticated and current_user.has_role('admin')
 
+class RoleModelView(CustomModelView):
+    def after_model_change(self, form, model, is_created):
+        role_registry.load()
+
+    def after_model_delete(self, model):
+        role_registry.load()
+
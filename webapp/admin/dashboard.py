@@ -0,0 +1,134 @@
+import time
+from flask import current_app
+from .. import db, cache
+from ..metrics import metrics, MAX_CACHE_PREFIXES
+from ..instrumentation import statement_totals, shape_memo_size, SHAPE_CACHE_SIZE
+from ..explain import explain_hot_queries, full_scans
+
+
+def endpoint_summary(values, limit=15):
+    """
+    Summarize the request metrics of every endpoint, slowest first.
+
+    Args:
+    - values (dict): The output of `metrics.collect()`.
+    - limit (int): The number of endpoints returned.
+
+    Returns:
+    - list: One dict per endpoint with requests, server errors, mean and p95
+      latency in ms, and SQL statements and time per request.
+    """
+    endpoints = {}
+    for key, value in values.items():
+        if key[0] == metrics.requests.name:
+            endpoint = endpoints.setdefault(key[1], {'endpoint': key[1], 'requests': 0, 'errors': 0})
+            endpoint['requests'] += value
+            if key[3].startswith('5'):
+                endpoint['errors'] += value
+    samples = {}
+    for name, labels, value in metrics.latency.samples(values):
+        samples.setdefault(labels['endpoint'], []).append((name, labels, value))
+    for name, endpoint in endpoints.items():
+        count = endpoint['requests'] or 1
+        buckets = [(labels['le'], value) for sample, labels, value in samples.get(name, ()) if sample.endswith('_bucket')]
+        total = values.get((metrics.latency.name + '_sum', name), 0.0)
+        endpoint['mean_ms'] = total / count * 1000
+        # The upper bound of the bucket holding the 95th percentile
+        endpoint['p95_ms'] = next(
+            (le if le == '+Inf' else float(le) * 1000 for le, cumulative in buckets if cumulative >= 0.95 * count),
+            None
+        )
+        endpoint['queries'] = values.get((metrics.sql_queries.name, name), 0.0) / count
+        endpoint['sql_ms'] = values.get((metrics.sql_seconds.name, name), 0.0) / count * 1000
+    return sorted(endpoints.values(), key=lambda endpoint: endpoint['mean_ms'], reverse=True)[:limit]
+
+
+def cache_summary(values):
+    """
+    Returns:
+    - list: Hits, misses, sets and hit ratio of every cache key prefix.
+    """
+    prefixes = {}
+    for key, value in values.items():
+        if key[0] == metrics.cache.name:
+            prefixes.setdefault(key[1], {'prefix': key[1], 'hit': 0, 'miss': 0, 'set': 0})[key[2]] += value
+    for prefix in prefixes.values():
+        lookups = prefix['hit'] + prefix['miss']
+        prefix['ratio'] = prefix['hit'] / lookups if lookups else None
+    return sorted(prefixes.values(), key=lambda prefix: prefix['hit'] + prefix['miss'], reverse=True)
+
+
+def table_counts():
+    """
+    Estimate the rows of every table without scanning any, so the page stays
+    cheap on large tables: PostgreSQL's planner estimate, MySQL's table
+    statistics, and on SQLite the largest rowid, a walk down one edge of the
+    table's b-tree that overcounts by the deleted rows.
+
+    Returns:
+    - list: (table name, estimated rows) pairs, rows are None on other databases.
+    """
+    tables = [table.name for table in db.metadata.sorted_tables]
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = 'SELECT relname, reltuples::bigint FROM pg_class WHERE relname IN :names'
+    elif dialect in ('mysql', 'mariadb'):
+        statement = ('SELECT table_name, table_rows FROM information_schema.tables '
+                     'WHERE table_schema = DATABASE() AND table_name IN :names')
+    else:
+        statement = None
+    if statement is not None:
+        rows = db.session.execute(
+            db.text(statement).bindparams(db.bindparam('names', expanding=True)), {'names': tables}
+        ).all()
+        return sorted(tuple(row) for row in rows)
+    if dialect == 'sqlite':
+        return [
+            (name, db.session.execute(db.text('SELECT max(rowid) FROM "%s"' % name)).scalar() or 0)
+            for name in tables
+        ]
+    # No cheap estimate elsewhere, and counting could take the page down with the database
+    return [(name, None) for name in tables]
+
+
+def index_usage():
+    """
+    Returns:
+    - list: The plan of every hot query in explain.py and whether it scans a whole table.
+    """
+    return [
+        {'name': name, 'plan': plan, 'full_scan': bool(full_scans(plan))}
+        for name, plan in explain_hot_queries().items()
+    ]
+
+
+def in_process_caches():
+    """
+    The current size of the caches held in this process' memory.
+
+    Returns:
+    - list: (name, size, detail) triples.
+    """
+    caches = []
+    roles = current_app.extensions.get('role_registry', {})
+    if roles.get('roles') is not None:
+        caches.append(('Role registry', len(roles['roles']), 'loaded %ds ago' % (time.monotonic() - roles['loaded_at'])))
+    backend = current_app.extensions.get('cache', {}).get(cache)
+    backend = getattr(backend, 'backend', backend)
+    entries = getattr(backend, '_cache', None)
+    caches.append(('View cache (%s)' % type(backend).__name__, len(entries) if entries is not None else None,
+                   'shared' if entries is None else 'this process'))
+    compiled = getattr(db.engine, '_compiled_cache', None)
+    if compiled is not None:
+        caches.append(('SQLAlchemy compiled statements', len(compiled), 'capacity %d' % compiled.capacity))
+    caches.append(('Statement shapes', shape_memo_size(), 'capacity %d' % SHAPE_CACHE_SIZE))
+    caches.append(('Statement totals', len(statement_totals), '%d executions dropped' % statement_totals.dropped))
+    caches.append(('Cache key prefixes', len(metrics.prefixes), 'capacity %d' % MAX_CACHE_PREFIXES))
+    last_seen = current_app.extensions.get('last_seen')
+    if last_seen is not None:
+        caches.append(('last_seen buffer', len(last_seen.pending), '%d users throttled' % len(last_seen.recorded)))
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is not None:
+        counts = hasher.metrics()
+        caches.append(('bcrypt queue', counts['queued'], '%d running' % counts['running']))
+    return caches
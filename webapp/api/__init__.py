@@ -1,5 +1,5 @@
 from flask_restful import Api
-from .blog.controllers import PostApi, CommentApi
+from .blog.controllers import PostApi, PostBulkApi, PostExportApi, CommentApi, SearchApi
 
 rest_api = Api()
 
@@ -10,10 +10,22 @@ def create_module(app, **kwargs):
         '/api/post',
         '/api/post/<int:post_id>'
     )
+    rest_api.add_resource(
+        PostBulkApi,
+        '/api/post/bulk'
+    )
     rest_api.add_resource(
         CommentApi,
         '/api/comment',
         '/api/comment/<int:comment_id>',
         '/api/post/<int:post_id>/comments',
     )
+    rest_api.add_resource(
+        PostExportApi,
+        '/api/export/posts'
+    )
+    rest_api.add_resource(
+        SearchApi,
+        '/api/search'
+    )
     rest_api.init_app(app)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import datetime
+import json
+from types import SimpleNamespace
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from webapp.blog.models import db, Post, tags, insert_rows, resolve_tags, render_text, update_tag_counts
+from webapp.blog.invalidation import invalidate_on_commit
+from webapp.auth.models import User, fan_out_posts
+from .parsers import post_post_parser
+
+
+def read_items(request):
+    """
+    Split a bulk request body into items.
+
+    The body is either a JSON array or NDJSON, one JSON object per line.
+
+    Args:
+        request: The Flask request.
+
+    Returns:
+        list: (item, error) pairs, the error is set when a line is not valid JSON.
+
+    Raises:
+        ValueError: If the body is a malformed JSON array.
+    """
+    body = request.get_data(as_text=True)
+    if request.mimetype != 'application/x-ndjson' and body.lstrip().startswith('['):
+        return [(item, None) for item in json.loads(body)]
+    items = []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            items.append((json.loads(line), None))
+        except ValueError as e:
+            items.append((None, 'Line %d is not valid JSON: %s' % (number, e)))
+    return items
+
+
+POST_KEYS = frozenset(['title', 'text', 'tags'])
+
+
+def _plain_args(item):
+    """
+    Build the args of a well-formed post without going through reqparse.
+
+    Only covers items whose parse is trivial: the keys post_post_parser
+    knows, string title and text, and tags as a list of strings. For those
+    the parser returns exactly this dict; anything else returns None and
+    takes the parser's path.
+    """
+    if not POST_KEYS.issuperset(item):
+        return None
+    title = item.get('title')
+    text = item.get('text')
+    tags = item.get('tags')
+    if type(title) is not str or type(text) is not str:
+        return None
+    if tags is not None and (type(tags) is not list or any(type(tag) is not str for tag in tags)):
+        return None
+    return {'title': title, 'text': text, 'tags': list(tags) if tags else None}
+
+
+def validate_post(item):
+    """
+    Check one item with the rules of post_post_parser.
+
+    Args:
+        item: The decoded JSON item.
+
+    Returns:
+        tuple: (args, None) when valid, else (None, error message).
+    """
+    if not isinstance(item, dict):
+        return None, 'Each post must be a JSON object'
+    args = _plain_args(item)
+    if args is not None:
+        return args, None
+    try:
+        request = SimpleNamespace(json=item, values=MultiDict())
+        return post_post_parser.parse_args(req=request, strict=True), None
+    except HTTPException as e:
+        return None, (getattr(e, 'data', None) or {}).get('message') or e.description
+
+
+def insert_posts(batch, user_id):
+    """
+    Insert validated posts with executemany statements and commit them.
+
+    Core inserts skip the ORM listeners, so the derived data they maintain
+    is written here: render columns, post_tags rows, Tag.post_count, the
+    followers' timelines and the cache dependencies. The full-text index is
+    kept by its triggers.
+
+    Args:
+        batch (list): Parsed args of post_post_parser.
+        user_id (int): The author.
+
+    Returns:
+        list: The new post ids, in the order of `batch`.
+    """
+    now = datetime.datetime.now()
+    rows = []
+    for args in batch:
+        row = {'title': args['title'], 'text': args['text'], 'publish_date': now, 'user_id': user_id}
+        row.update(render_text(args['text']))
+        rows.append(row)
+    ids = insert_rows(Post.__table__, rows)
+
+    titles = [title for args in batch for title in args['tags'] or []]
+    tag_ids = {tag.title: tag.id for tag in resolve_tags(titles)}
+    links = []
+    deltas = {}
+    for post_id, args in zip(ids, batch):
+        for tag_id in {tag_ids[title] for title in args['tags'] or [] if title in tag_ids}:
+            links.append({'post_id': post_id, 'tag_id': tag_id})
+            deltas[tag_id] = deltas.get(tag_id, 0) + 1
+    connection = db.session.connection()
+    if links:
+        connection.execute(tags.insert(), links)
+    update_tag_counts(connection, deltas)
+    fan_out_posts(connection, [
+        {'post_id': post_id, 'user_id': user_id, 'publish_date': now} for post_id in ids
+    ])
+
+    username = db.session.execute(db.select(User.username).where(User.id == user_id)).scalar()
+    invalidate_on_commit('sidebar', 'user/%s' % username, *['tag/%s' % title for title in tag_ids])
+    db.session.commit()
+    return ids
@@ -1,20 +1,26 @@
 import datetime
 from email.policy import strict
 
-from flask import abort, current_app, jsonify, request
-from flask_restful import Resource, fields, marshal_with, abort
+from flask import abort, current_app, jsonify, request, Response, stream_with_context
+from flask_restful import Resource, fields, abort
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from webapp.blog.models import db, Post, Tag, Comment
+from sqlalchemy.orm import selectinload
+from webapp.blog.models import db, Post, Tag, Comment, add_tags_to_post, posts_modified
+from webapp.blog.search import search_posts
 from webapp.auth.models import User
+from webapp.conditional import make_etag, revalidate
 from .parsers import (
     post_get_parser,
     post_post_parser,
     post_put_parser,
     comment_get_parser,
     comment_post_parser,
-    comment_put_parser
+    comment_put_parser,
+    search_get_parser
 )
-from .fields import HTMLField
+from .pagination import keyset_page
+from .bulk import read_items, validate_post, insert_posts
+from .serializers import Serializer
 
 nested_tag_fields = {
     'id': fields.Integer(),
@@ -25,7 +31,7 @@ post_fields = {
     'id': fields.Integer(),
     'user_id': fields.Integer(),
     'title': fields.String(),
-    'text': HTMLField(),
+    'text': fields.String(attribute='plain_text'),
     'tags': fields.List(fields.Nested(nested_tag_fields)),
     'publish_date': fields.DateTime(dt_format='iso8601')
 }
@@ -34,21 +40,13 @@ comment_fields = {
     'post_id': fields.Integer(),
     'user_id': fields.Integer(),
     'name': fields.String(),
-    'text': HTMLField(),
+    'text': fields.String(attribute='plain_text'),
     'date': fields.DateTime(dt_format='iso8601')
 }
-def add_tags_to_post(post, tags_list):
-    for item in tags_list:
-        tag = Tag.query.filter_by(title=item).first()
-
-        if tag:
-            post.tags.append(tag)
-        else:
-            new_tag = Tag(item)
-            post.tags.append(new_tag)
+post_serializer = Serializer(post_fields)
+comment_serializer = Serializer(comment_fields)
 
 class PostApi(Resource):
-    @marshal_with(post_fields)
     @jwt_required()
     def get(self, post_id=None):
         """
@@ -57,41 +55,77 @@ class PostApi(Resource):
         Args:
             post_id (int): The ID of the post to retrieve. Defaults to None.
 
+        When a 'cursor' argument is given (empty for the first page), the list
+        is paginated by (publish_date, id) instead of page number and wrapped
+        with the cursor of the next page.
+
+        The post and the numbered pages carry an ETag and Last-Modified derived
+        from Post.updated_at, and a matching If-None-Match or If-Modified-Since
+        gets a 304 before the posts are loaded.
+
         Returns:
             Post or list of Post: The requested post(s).
 
+            dict: 'items' and 'next_cursor' in cursor mode.
+
         Raises:
             404: If the post with the given ID is non-existent.
 
-        400: If 'page' or 'user' args are invalid.
+        400: If 'page', 'cursor' or 'user' args are invalid.
 
         401: If authentication is required.
 
         403: If trying to edit a post not created by the current user.
         """
         if post_id:
-            post = Post.query.get(post_id)
+            count, updated_at = posts_modified(Post.id == post_id)
+            if not count:
+                abort(404, message="Post id is non-existent")
+            not_modified = revalidate(make_etag(post_id, updated_at), updated_at)
+            if not_modified is not None:
+                return not_modified
+            post = Post.query.options(db.undefer(Post.text_plain)).get(post_id)
             if not post:
                 abort(404, message="Post id is non-existent")
-            return post
+            return post_serializer.serialize(post)
         else:
             args = post_get_parser.parse_args()
             page = args['page'] or 1
+            per_page = current_app.config.get('POSTS_PER_PAGE', 10)
 
             if args['user']:
                 user = User.query.filter_by(username=args['user']).first()
                 if not user:
                     abort(404, message="Username not found...")
-                
-                posts = user.posts.order_by(
-                    Post.publish_date.desc()
-                ).paginate(page=args['page'] or 1,per_page=current_app.config.get('POSTS_PER_PAGE', 10),error_out=False)
+                posts = user.posts
+                criteria = [Post.user_id == user.id]
             else:
-                posts = Post.query.order_by(
-                    Post.publish_date.desc()
-                ).paginate(page=args['page'] or 1,per_page=current_app.config.get('POSTS_PER_PAGE', 10),error_out=False)
-
-            return posts.items
+                posts = Post.query
+                criteria = []
+            if args['cursor'] is None:
+                # The page can only change if the posts it is cut from do. Cursor pages are
+                # not validated, it would cost the COUNT(*) they are meant to avoid
+                count, updated_at = posts_modified(*criteria)
+                not_modified = revalidate(
+                    make_etag(sorted(request.args.items(multi=True)), per_page, count, updated_at), updated_at
+                )
+                if not_modified is not None:
+                    return not_modified
+            # One SELECT ... IN for the tags of the whole page instead of one per post
+            posts = posts.options(db.undefer(Post.text_plain), selectinload(Post.tags))
+
+            if args['cursor'] is not None:
+                try:
+                    items, next_cursor = keyset_page(posts, Post.publish_date, Post.id, args['cursor'], per_page)
+                except ValueError:
+                    abort(400, message="Invalid cursor...")
+                return {'items': post_serializer.serialize(items), 'next_cursor': next_cursor}
+
+            posts = posts.order_by(
+                Post.publish_date.desc()
+            ).paginate(page=page,per_page=per_page,error_out=False)
+
+            return post_serializer.serialize(posts.items)
     
     @jwt_required()
     def post(self):
@@ -189,7 +223,6 @@ class PostApi(Resource):
         return "", 204
     
 class CommentApi(Resource):
-    @marshal_with(comment_fields)
     @jwt_required()
     def get(self, comment_id=None, post_id=None):
         """
@@ -199,11 +232,17 @@ class CommentApi(Resource):
             comment_id (int): The ID of the comment to retrieve. Defaults to None.
             post_id (int): The ID of the post to retrieve comments for. Defaults to None.
 
+        When a 'cursor' argument is given (empty for the first page), the list
+        is paginated by (date, id) instead of page number and wrapped with the
+        cursor of the next page.
+
         Returns:
             Comment or list of Comment: The requested comment(s).
 
+            dict: 'items' and 'next_cursor' in cursor mode.
+
         Raises:
-            400: If 'page' or 'user' args are invalid.
+            400: If 'page', 'cursor' or 'user' args are invalid.
 
             401: If authentication is required.
 
@@ -214,7 +253,7 @@ class CommentApi(Resource):
             if not comment:
                 abort(404, message="Comment id non-exixtent")
                 print(f"comment: {comment}")
-            return comment
+            return comment_serializer.serialize(comment)
         if post_id:
             post = Post.query.get(post_id)
             if not post:
@@ -222,7 +261,7 @@ class CommentApi(Resource):
             comments = post.comments.order_by(
                 Comment.date.desc()
             )
-            return comments
+            return comment_serializer.serialize(comments.all())
             
         else:
             args = comment_get_parser.parse_args()
@@ -233,14 +272,21 @@ class CommentApi(Resource):
 
                 if not user:
                     abort(404, message='User not found...')
-                comments = user.comments.order_by(
-                    Comment.date.desc()
-                ).paginate(page=args['page'] or 1, per_page=10, error_out=False)
+                comments = user.comments
             else:
-                comments = Comment.query.order_by(
-                    Comment.date.desc()
-                ).paginate(page=args['page'] or 1, per_page=10, error_out=False)
-            return comments.items
+                comments = Comment.query
+
+            if args['cursor'] is not None:
+                try:
+                    items, next_cursor = keyset_page(comments, Comment.date, Comment.id, args['cursor'], 10)
+                except ValueError:
+                    abort(400, message="Invalid cursor...")
+                return {'items': comment_serializer.serialize(items), 'next_cursor': next_cursor}
+
+            comments = comments.order_by(
+                Comment.date.desc()
+            ).paginate(page=page, per_page=10, error_out=False)
+            return comment_serializer.serialize(comments.items)
     
     @jwt_required()
     def post(self, post_id=None):
@@ -340,4 +386,115 @@ class CommentApi(Resource):
         
         db.session.delete(comment)
         db.session.commit()
-        return "", 204
\ No newline at end of file
+        return "", 204
+
+class PostBulkApi(Resource):
+    @jwt_required()
+    def post(self):
+        """
+        Create many posts in one request.
+
+        The body is a JSON array of posts, or NDJSON with one post per line.
+        Each post is checked with the rules of POST /api/post, and the valid
+        ones are inserted in batches of API_BULK_BATCH_SIZE, one transaction
+        per batch.
+
+        Returns:
+            dict: 'items' holding the 'id' or the 'error' of each post, in
+            input order, and the number of posts 'created' and 'failed'.
+            The status is 201 when every post was created, else 207.
+
+        Raises:
+            400: If the body is a malformed JSON array.
+
+            401: If authentication is required.
+
+            413: If the body holds more than API_BULK_MAX_ITEMS posts.
+        """
+        try:
+            items = read_items(request)
+        except ValueError as e:
+            abort(400, message="Invalid JSON body: %s" % e)
+        max_items = current_app.config.get('API_BULK_MAX_ITEMS', 50000)
+        if len(items) > max_items:
+            abort(413, message="At most %d posts per request..." % max_items)
+
+        results = [None] * len(items)
+        valid = []
+        for i, (item, error) in enumerate(items):
+            if error is None:
+                args, error = validate_post(item)
+            if error is None:
+                valid.append((i, args))
+            else:
+                results[i] = {'error': error}
+
+        user_id = get_jwt_identity()
+        batch_size = current_app.config.get('API_BULK_BATCH_SIZE', 1000)
+        for start in range(0, len(valid), batch_size):
+            batch = valid[start:start + batch_size]
+            try:
+                ids = insert_posts([args for i, args in batch], user_id)
+            except Exception as e:
+                db.session.rollback()
+                for i, args in batch:
+                    results[i] = {'error': "Insert failed: %s" % e}
+            else:
+                for (i, args), post_id in zip(batch, ids):
+                    results[i] = {'id': post_id}
+
+        created = sum(1 for result in results if 'id' in result)
+        status = 201 if created == len(results) else 207
+        return {'items': results, 'created': created, 'failed': len(results) - created}, status
+
+class PostExportApi(Resource):
+    @jwt_required()
+    def get(self):
+        """
+        Stream every post as NDJSON, one post per line.
+
+        The rows are read in batches and sent as they are serialized, so the
+        response never holds the whole table. It is gzipped when the client
+        accepts gzip.
+
+        Returns:
+            Response: A streamed application/x-ndjson response.
+
+        Raises:
+            401: If authentication is required.
+        """
+        from webapp.export import export_chunks
+        compress = request.accept_encodings['gzip'] > 0
+        response = Response(
+            stream_with_context(export_chunks('posts', gzip=compress)),
+            mimetype='application/x-ndjson'
+        )
+        response.vary.add('Accept-Encoding')
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+class SearchApi(Resource):
+    @jwt_required()
+    def get(self):
+        """
+        Full-text search over posts, ranked by relevance.
+
+        Returns:
+            dict: The matching posts with a highlighted 'snippet', the 'total'
+            number of matches and the current 'page'.
+
+        Raises:
+            400: If the 'q' arg is missing or 'page' is invalid.
+
+            401: If authentication is required.
+        """
+        args = search_get_parser.parse_args()
+        page = max(args['page'] or 1, 1)
+        results = search_posts(args['q'], page=page, per_page=current_app.config.get('POSTS_PER_PAGE', 10))
+        items = [dict(post_serializer.serialize(post), snippet=str(snippet)) for post, snippet in results.items]
+        return {
+            'items': items,
+            'total': results.total,
+            'page': results.page
+        }
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import datetime
+import json
+from sqlalchemy import and_, or_
+
+
+def encode_cursor(date, id):
+    """
+    Encode the sort key of the last item of a page into an opaque cursor.
+
+    Args:
+        date (datetime): The date the page is ordered by, None for undated rows.
+        id (int): The id used to break ties between equal dates.
+
+    Returns:
+        str: A URL safe cursor.
+    """
+    payload = json.dumps([date.isoformat() if date is not None else None, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by `encode_cursor`.
+
+    Args:
+        cursor (str): The opaque cursor.
+
+    Returns:
+        tuple: The (date, id) sort key, the date is None past the dated rows.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        date, id = json.loads(payload)
+        return (datetime.datetime.fromisoformat(date) if date is not None else None), int(id)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor: %s" % e)
+
+
+def keyset_page(query, date_column, id_column, cursor, per_page):
+    """
+    Fetch one page of `query` ordered by (date, id) descending.
+
+    Instead of OFFSET and COUNT(*), the page starts right after the sort key
+    carried by the cursor, so every page costs the same index range scan.
+    Rows without a date follow the dated ones, whatever the database's NULL
+    ordering, ordered by id alone.
+
+    Args:
+        query (Query): The query to paginate.
+        date_column (Column): The date column the feed is ordered by.
+        id_column (Column): The primary key, used to break ties.
+        cursor (str): The cursor of the previous page, or '' for the first page.
+        per_page (int): The number of items per page.
+
+    Returns:
+        tuple: The items of the page and the cursor of the next page (None on the last page).
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    limit = per_page + 1
+    if not cursor:
+        date = None
+        dated = date_column.isnot(None)
+    else:
+        date, id = decode_cursor(cursor)
+        dated = or_(date_column < date, and_(date_column == date, id_column < id)) if date is not None else None
+    items = []
+    if dated is not None:
+        items = query.filter(dated).order_by(date_column.desc(), id_column.desc()).limit(limit).all()
+    if len(items) < limit:
+        # Rows without a date (legacy or admin-created ones) come last, by id
+        undated = query.filter(date_column.is_(None))
+        if cursor and date is None:
+            undated = undated.filter(id_column < id)
+        items += undated.order_by(id_column.desc()).limit(limit - len(items)).all()
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
+    return items, next_cursor
@@ -7,6 +7,11 @@ user_post_parser.add_argument('password', type=str, required=True)
 post_get_parser = reqparse.RequestParser()
 post_get_parser.add_argument('page', type=int, location=['args', 'headers'])
 post_get_parser.add_argument('user', type=str, location=['args', 'headers'])
+post_get_parser.add_argument('cursor', type=str, location=['args', 'headers'])
+
+search_get_parser = reqparse.RequestParser()
+search_get_parser.add_argument('q', type=str, required=True, help='Search query required', location=['args'])
+search_get_parser.add_argument('page', type=int, location=['args', 'headers'])
 
 post_post_parser = reqparse.RequestParser()
 post_post_parser.add_argument(
@@ -51,6 +56,7 @@ post_put_parser.add_argument(
 comment_get_parser = reqparse.RequestParser()
 comment_get_parser.add_argument('page', type=int, location=['args', 'headers'])
 comment_get_parser.add_argument('user', type=str, location=['args', 'headers'])
+comment_get_parser.add_argument('cursor', type=str, location=['args', 'headers'])
 
 comment_post_parser = reqparse.RequestParser()
 comment_post_parser.add_argument(
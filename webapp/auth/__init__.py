@@ -6,7 +6,7 @@ from flask_dance.contrib.github import make_github_blueprint, github
 from flask_dance.consumer import oauth_authorized
 from flask_login import LoginManager, login_user
 from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager
+from flask_jwt_extended import JWTManager, get_jwt
 
 
 bcrypt= Bcrypt()
@@ -39,6 +39,12 @@ def create_module(app, **kwargs):
     login_manager.init_app(app)
     jwt.init_app(app)
 
+    # Records last_seen for every blueprint, written behind in batches
+    from .last_seen import last_seen
+    last_seen.init_app(app)
+    from .passwords import password_hasher
+    password_hasher.init_app(app)
+
     github_blueprint = make_github_blueprint(
         client_id=app.config.get("GITHUB_CLIENT_ID"),
         client_secret=app.config.get('GITHUB_CLIENT_SECRET')
@@ -53,6 +59,8 @@ def create_module(app, **kwargs):
     app.register_blueprint(google_blueprint, url_prefix="/login")
 
     from .controllers import auth_blueprint
+    # Registers the listeners dropping stale user snapshots
+    from . import cached_user
     app.register_blueprint(auth_blueprint)
 
 def has_role(name):
@@ -77,13 +85,33 @@ def has_role(name):
     """
     def real_decorator(f):
         def wraps(*args, **kwargs):
-            if current_user.has_role(name):
+            if name in current_role_names():
                 return f(*args, **kwargs)
             else:
                 abort(403)
         return functools.update_wrapper(wraps, f)
     return real_decorator
 
+def current_role_names():
+    """
+    The role names of whoever makes the current request.
+
+    API requests read them from the 'roles' claim of their JWT, other requests
+    from the logged in user, so neither needs a query or a cache lookup.
+
+    Returns:
+        frozenset: The role names, empty for anonymous users.
+    """
+    try:
+        claims = get_jwt()
+    except RuntimeError:
+        claims = {}
+    if 'roles' in claims:
+        return frozenset(claims['roles'])
+    if current_user.is_authenticated:
+        return current_user.role_names
+    return frozenset()
+
 def authenticate(username, password):
     """
     Authenticate a user based on their username and password.
@@ -94,12 +122,16 @@ def authenticate(username, password):
 
     Returns:
         User or None: The authenticated user or None if authentication fails.
+
+    Raises:
+        HasherBusy: If too many password checks are already queued.
     """
     from .models import User
+    from .passwords import password_hasher
     user = User.query.filter_by(username=username).first()
     if not user:
         return None
-    if not user.check_password(password):
+    if not password_hasher.check(user, password):
         return None
     return user
 
@@ -120,14 +152,17 @@ def load_user(userid):
     """
     Load a user by their user ID.
 
+    Served from a short-lived snapshot in the shared cache, so most requests
+    never query the user or its roles. See `cached_user.CachedUser`.
+
     Args:
         userid: The user's ID.
 
     Returns:
-        User: The user associated with the provided user ID.
+        CachedUser: The user associated with the provided user ID.
     """
-    from .models import User
-    return User.query.get(userid)
+    from .cached_user import load_cached_user
+    return load_cached_user(userid)
 
 
 @oauth_authorized.connect
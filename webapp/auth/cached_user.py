@@ -0,0 +1,161 @@
+from flask import current_app
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+from .. import db, cache
+from .models import User, Role, roles
+
+SNAPSHOT_KEY = 'user_snapshot/%s'
+
+
+def snapshot_user(user):
+    """
+    Build the compact copy of a user kept in the shared cache.
+
+    Args:
+    - user (User): The loaded user.
+
+    Returns:
+    - dict: The user's id, username and sorted role names.
+    """
+    return {
+        'id': user.id,
+        'username': user.username,
+        'role_names': tuple(sorted(user.role_names)),
+    }
+
+
+class CachedUser(UserMixin):
+    """
+    The logged in user as most requests need it.
+
+    Reads of id, username and role names are served from the snapshot. Any
+    other attribute, and every assignment, loads the User row on first use
+    and is delegated to it, so views that change the user keep working on the
+    real ORM object. Equality comes from UserMixin, so a CachedUser equals the
+    User with the same id.
+    """
+    def __init__(self, snapshot, user=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_role_names', frozenset(snapshot['role_names']))
+        object.__setattr__(self, '_user', user)
+
+    @property
+    def id(self):
+        return self._snapshot['id']
+
+    @property
+    def username(self):
+        return self._snapshot['username']
+
+    @property
+    def role_names(self):
+        return self._role_names
+
+    def has_role(self, name):
+        return name in self._role_names
+
+    # Only need the snapshot fields
+    avatar = User.avatar
+    following_ids = User.following_ids
+    followed_posts = User.followed_posts
+
+    def get_user(self):
+        """
+        Load the User row behind the snapshot, once per request.
+
+        Returns:
+        - User: The ORM user.
+        """
+        if self._user is None:
+            object.__setattr__(self, '_user', db.session.get(User, self.id))
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_user(), name, value)
+        if name == 'username':
+            object.__setattr__(self, '_snapshot', dict(self._snapshot, username=value))
+
+    def __repr__(self):
+        return '<User {}>'.format(self.username)
+
+
+def load_cached_user(userid):
+    """
+    Load the logged in user from its cached snapshot, falling back to the
+    database on a miss.
+
+    Args:
+    - userid: The user's ID, as stored in the session.
+
+    Returns:
+    - CachedUser: The user, or None if it does not exist.
+    """
+    try:
+        key = SNAPSHOT_KEY % int(userid)
+    except (TypeError, ValueError):
+        return None
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        return CachedUser(snapshot)
+    user = db.session.get(User, int(userid))
+    if user is None:
+        return None
+    snapshot = snapshot_user(user)
+    cache.set(key, snapshot, timeout=current_app.config.get('USER_CACHE_TIMEOUT', 60))
+    return CachedUser(snapshot, user)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_role_holders(session, flush_context, instances):
+    """
+    Remember the holders of every role renamed or deleted in this flush.
+
+    Read before the flush, which deletes the role_users rows of a deleted role.
+    """
+    role_ids = [
+        role.id for role in list(session.dirty) + list(session.deleted)
+        if isinstance(role, Role) and role.id is not None
+        and (role in session.deleted or session.is_modified(role))
+    ]
+    if role_ids:
+        holders = session.execute(db.select(roles.c.user_id).where(roles.c.role_id.in_(role_ids))).scalars()
+        session.info.setdefault('changed_users', set()).update(holders)
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    """
+    Remember the users whose snapshot changed in this flush.
+    """
+    changed = session.info.setdefault('changed_users', set())
+    for user in session.deleted:
+        if isinstance(user, User):
+            changed.add(user.id)
+    for user in session.dirty:
+        if not isinstance(user, User):
+            continue
+        for key in ('username', 'roles'):
+            if attributes.get_history(user, key, passive=attributes.PASSIVE_NO_INITIALIZE).has_changes():
+                changed.add(user.id)
+                break
+
+
+@event.listens_for(db.session, 'after_commit')
+def drop_changed_snapshots(session):
+    """
+    Delete the snapshots of the users changed by the committed transaction.
+    """
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        cache.delete_many(*[SNAPSHOT_KEY % id for id in changed])
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_users', None)
@@ -1,6 +1,6 @@
-import datetime
 from urllib import request
 from flask import (render_template,
+                   current_app,
                    Blueprint,
                    redirect,
                    url_for,
@@ -11,7 +11,9 @@ from flask_login import login_user, logout_user
 from flask_jwt_extended import create_access_token
 from . import authenticate
 from .models import db, User
+from .passwords import HasherBusy
 from .forms import LoginForm, RegisterForm,EditProfileForm, EmptyForm
+from ..blog.invalidation import invalidate
 from flask_babel import _
 from flask_login import login_required, current_user
 
@@ -22,19 +24,6 @@ auth_blueprint = Blueprint(
     url_prefix='/auth'
 )
 
-@auth_blueprint.before_request
-def before_request():
-    """
-    Execute actions before handling a request.
-
-    This function updates the user's last_seen timestamp.
-
-    Returns:
-    - None
-    """
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.datetime.utcnow()
-
 @auth_blueprint.route('/api', methods=['POST'])
 def api():
     """
@@ -47,6 +36,7 @@ def api():
     - 400 if JSON is missing.
     - 400 if username or password is missing.
     - 401 if the username or password is incorrect.
+    - 503 if too many password checks are already queued.
     - 200 with an access token if authentication is successful.
     """
     if not request.is_json:
@@ -58,11 +48,14 @@ def api():
         return jsonify({'msg':'Missing username parameter'}), 400
     if not password:
         return jsonify({'msg':'Missing password parameter'}), 400
-    user = authenticate(username, password)
+    try:
+        user = authenticate(username, password)
+    except HasherBusy:
+        return jsonify({'msg': 'Too many sign-in attempts, try again later'}), 503
     if not user:
         return jsonify({"msg":"Bad username or password"}), 401
     
-    access_token = create_access_token(identity=user.id)
+    access_token = create_access_token(identity=user.id, additional_claims={'roles': sorted(user.role_names)})
     return jsonify(access_token=access_token), 200
 
 @auth_blueprint.route('/login', methods=['GET', 'POST'])
@@ -80,8 +73,7 @@ def login():
     form = LoginForm()
     
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).one()
-        login_user(user,  remember=form.remember.data)
+        login_user(form.user,  remember=form.remember.data)
         flash(_('You have been logged in.'), category='success')
         return redirect(url_for('main.index'))
 
@@ -148,6 +140,7 @@ def follow(username):
             return redirect(url_for('user', username=username))
         current_user.follow(user)
         db.session.commit()
+        invalidate('followed/%s' % current_user.id)
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('auth.user_profiles', username=username))
     else:
@@ -176,6 +169,7 @@ def unfollow(username):
             return redirect(url_for('user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        invalidate('followed/%s' % current_user.id)
         flash(_('You are no longer following %(username)s!', username=username))
         return redirect(url_for('auth.user_profiles', username=username))
     else:
@@ -187,14 +181,19 @@ def user_profiles():
     """
     User profiles view.
 
-    Displays a list of user profiles.
+    Displays a page of user profiles. The follow state and following counts
+    of the whole page are loaded with one query each.
 
     Returns:
     - Renders a list of user profiles.
     """
-    users = User.query.all()
+    page = request.args.get('page', 1, type=int)
+    users = User.query.order_by(User.username).paginate(page=page, per_page=current_app.config.get('USERS_PER_PAGE', 20), error_out=False)
+    user_ids = [user.id for user in users.items]
+    following = current_user.following_ids(user_ids)
+    following_counts = User.following_counts(user_ids)
     form = EmptyForm()
-    return render_template('user_profiles.html', users=users, form=form)
+    return render_template('user_profiles.html', users=users, following=following, following_counts=following_counts, form=form)
 
 @auth_blueprint.route('/register', methods=['GET', 'POST'])
 def register():
@@ -3,6 +3,7 @@ from flask_wtf.recaptcha import RecaptchaField
 from wtforms import StringField, PasswordField, BooleanField,SubmitField
 from wtforms.validators import DataRequired, Length, EqualTo, URL
 from .models import User
+from .passwords import password_hasher, HasherBusy
 from flask_babel import lazy_gettext as _l
 
 class LoginForm(FlaskForm):
@@ -22,9 +23,16 @@ class LoginForm(FlaskForm):
             self.username.errors.append(_l('Invalid username or password'))
             return False
         
-        if not user.check_password(self.password.data):
+        try:
+            valid = password_hasher.check(user, self.password.data)
+        except HasherBusy:
+            self.username.errors.append(_l('Too many sign-in attempts, please try again'))
+            return False
+        if not valid:
             self.username.errors.append(_l('Invalid username or password'))
             return False
+        # Handed to the view so it does not load the user again
+        self.user = user
         return True
 
 
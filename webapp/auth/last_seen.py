@@ -0,0 +1,131 @@
+import atexit
+import datetime
+import logging
+import os
+import threading
+from flask import request
+from flask_login import current_user
+from sqlalchemy import bindparam
+from .. import db
+
+log = logging.getLogger(__name__)
+
+
+class LastSeenBuffer(object):
+    """
+    Write-behind buffer for User.last_seen.
+
+    Requests only record the time in memory, at most once per user every
+    LAST_SEEN_THROTTLE seconds. A background thread writes the buffered times
+    with one batched UPDATE every LAST_SEEN_FLUSH_INTERVAL seconds, and the
+    buffer is flushed once more when the process exits. An interval of 0
+    disables the thread; call `flush` explicitly then.
+
+    Example:
+    ```python
+    last_seen.init_app(app)
+    ```
+    """
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.recorded = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def init_app(self, app):
+        self.app = app
+        with self.lock:
+            self.pending = {}
+            self.recorded = {}
+        app.extensions['last_seen'] = self
+        app.before_request(self.before_request)
+
+    def before_request(self):
+        if request.endpoint != 'static' and current_user.is_authenticated:
+            self.touch(current_user.id)
+
+    def touch(self, user_id, now=None):
+        """
+        Record that a user was seen.
+
+        Args:
+        - user_id (int): The user's ID.
+        - now (datetime): When the user was seen, defaults to utcnow().
+
+        Returns:
+        - bool: False if the user was already recorded within the throttle window.
+        """
+        now = now or datetime.datetime.utcnow()
+        throttle = datetime.timedelta(seconds=self.app.config.get('LAST_SEEN_THROTTLE', 60))
+        with self.lock:
+            last = self.recorded.get(user_id)
+            if last is not None and now - last < throttle:
+                return False
+            self.recorded[user_id] = now
+            self.pending[user_id] = now
+        self.start()
+        return True
+
+    def start(self):
+        """
+        Start the flusher thread, once per process (workers may be forked
+        after the application was created).
+        """
+        interval = self.app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30)
+        if not interval or (self.thread is not None and self.pid == os.getpid()):
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, args=(interval,), name='last-seen-flusher', daemon=True)
+            self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self, interval):
+        while not self.stopped.wait(interval):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def flush(self):
+        """
+        Write the buffered times with a single UPDATE statement.
+
+        Returns:
+        - int: The number of users written.
+        """
+        throttle = datetime.timedelta(seconds=self.app.config.get('LAST_SEEN_THROTTLE', 60))
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            # Forget users outside the throttle window so the map stays small
+            horizon = datetime.datetime.utcnow() - throttle
+            self.recorded = {id: seen for id, seen in self.recorded.items() if seen > horizon}
+        if not pending:
+            return 0
+        from .models import User
+        table = User.__table__
+        try:
+            with self.app.app_context(), db.engine.begin() as connection:
+                connection.execute(
+                    table.update().where(table.c.id == bindparam('b_id'))
+                    .values(last_seen=bindparam('b_last_seen')),
+                    [{'b_id': id, 'b_last_seen': seen} for id, seen in pending.items()]
+                )
+        except Exception as e:
+            log.error("Failed to write last_seen for %d users: %s" % (len(pending), e))
+            with self.lock:
+                for id, seen in pending.items():
+                    if id not in self.pending:
+                        self.pending[id] = seen
+            return 0
+        return len(pending)
+
+
+last_seen = LastSeenBuffer()
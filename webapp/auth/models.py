@@ -1,22 +1,42 @@
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy import bindparam, event
+from sqlalchemy.orm import attributes, make_transient_to_detached
 from . import bcrypt
-from .. import db, cache
+from .. import db
 from datetime import datetime
+import time
 from ..blog.models import Post
 from hashlib import sha256
 
 roles = db.Table(
     'role_users',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('role_id', db.Integer, db.ForeignKey('role.id'))
+    db.Column('role_id', db.Integer, db.ForeignKey('role.id')),
+    db.UniqueConstraint('user_id', 'role_id')
 )
 
 followers = db.Table(
     'followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.UniqueConstraint('follower_id', 'followed_id'),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
+# Materialized home feed: one row per post for its author and for each of the
+# author's followers, so reading a feed is a range scan of the primary key.
+# Authors with more than TIMELINE_FANOUT_LIMIT followers are skipped on write
+# and merged in by followed_posts() at read time instead.
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('publish_date', db.DateTime, primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Index('ix_timeline_post_id', 'post_id')
+)
+TIMELINE_COLUMNS = ['user_id', 'publish_date', 'post_id']
+
 class User(UserMixin, db.Model):
     """
     User model for managing user data.
@@ -27,6 +47,7 @@ class User(UserMixin, db.Model):
     - password (str): Hashed password for the user.
     - about_me (str): Short description about the user.
     - last_seen (datetime): Timestamp for the user's last activity.
+    - follower_count (int): The number of users following this user.
     - posts (relationship): A relationship to the Post model via a foreign key.
     - comments (relationship): A relationship to the Comment model via a foreign key.
     - roles (relationship): A relationship to the Role model through a many-to-many relationship.
@@ -35,12 +56,15 @@ class User(UserMixin, db.Model):
     Methods:
     - __init__(self, username=''): Constructor for User objects.
     - avatar(self, size): Generate a Gravatar URL for the user's avatar.
+    - role_names (frozenset): The names of the user's roles, loaded once per instance.
     - has_role(self, name): Check if the user has a specific role.
     - set_password(self, password): Set and hash the user's password.
     - check_password(self, password): Check if a given password matches the user's hashed password.
     - follow(self, user): Follow another user.
     - unfollow(self, user): Unfollow a user.
     - is_following(self, user): Check if the user is following another user.
+    - following_ids(self, user_ids=None): The ids of the users followed by the user, in one query.
+    - following_counts(cls, user_ids): How many users each of the given users follows, in one query.
     - followed_posts(self): Retrieve posts of followed users.
 
     """
@@ -49,6 +73,7 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(255))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow())
+    follower_count = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
     posts = db.relationship('Post', backref='user', lazy='dynamic')
     comments = db.relationship('Comment', backref='user', lazy='dynamic')
 
@@ -66,8 +91,7 @@ class User(UserMixin, db.Model):
     )
 
     def __init__(self, username=''):
-        default = Role.query.filter_by(name='default').one()
-        self.roles.append(default)
+        self.roles.append(role_registry['default'])
         self.username = username
 
     def __repr__(self):
@@ -80,12 +104,16 @@ class User(UserMixin, db.Model):
         )
     
     
-    @cache.memoize(60)
+    @property
+    def role_names(self):
+        names = getattr(self, '_role_names', None)
+        if names is None:
+            names = frozenset(role.name for role in self.roles)
+            self._role_names = names
+        return names
+
     def has_role(self, name):
-        for role in self.roles:
-            if role.name == name:
-                return True
-        return False
+        return name in self.role_names
     
     def set_password(self, password):
         self.password = bcrypt.generate_password_hash(password)
@@ -98,22 +126,58 @@ class User(UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            count = (user.follower_count or 0) + 1
+            user.follower_count = User.follower_count + 1
+            if count <= fan_out_limit():
+                db.session.execute(timeline.insert().from_select(
+                    TIMELINE_COLUMNS,
+                    db.select(db.literal(self.id), Post.publish_date, Post.id).where(
+                        Post.user_id == user.id, Post.publish_date.isnot(None))
+                ))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            count = (user.follower_count or 0) - 1
+            user.follower_count = User.follower_count - 1
+            db.session.execute(timeline.delete().where(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(db.select(Post.id).where(Post.user_id == user.id))
+            ))
+            if count == fan_out_limit():
+                # Back under the limit: posts written meanwhile were never fanned out
+                backfill_author(user.id, exclude=self.id)
 
     def is_following(self, user):
         return self.followed.filter(
             followers.c.followed_id == user.id
         ).count() > 0
 
+    def following_ids(self, user_ids=None):
+        query = db.select(followers.c.followed_id).where(followers.c.follower_id == self.id)
+        if user_ids is not None:
+            query = query.where(followers.c.followed_id.in_(user_ids))
+        return set(db.session.execute(query).scalars())
+
+    @classmethod
+    def following_counts(cls, user_ids):
+        if not user_ids:
+            return {}
+        query = db.select(followers.c.follower_id, db.func.count()).where(
+            followers.c.follower_id.in_(user_ids)).group_by(followers.c.follower_id)
+        return dict(db.session.execute(query).all())
+
     def followed_posts(self):
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-            followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.publish_date.desc())
+        posts = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id)
+        # Followed authors too popular to be fanned out on write
+        fan_out_on_read = db.select(followers.c.followed_id).join(
+            User, User.id == followers.c.followed_id).where(
+            followers.c.follower_id == self.id, User.follower_count > fan_out_limit())
+        if db.session.execute(fan_out_on_read.limit(1)).first() is None:
+            return posts.order_by(timeline.c.publish_date.desc(), timeline.c.post_id.desc())
+        popular = Post.query.filter(Post.user_id.in_(fan_out_on_read))
+        return posts.union(popular).order_by(Post.publish_date.desc())
         
 class Role(db.Model):
     """
@@ -136,4 +200,228 @@ class Role(db.Model):
         self.name = name
 
     def __repr__(self):
-        return '<Role {}>'.format(self.name)
\ No newline at end of file
+        return '<Role {}>'.format(self.name)
+
+
+class RoleRegistry(object):
+    """
+    In-process map of role names to role rows.
+
+    Roles are few and rarely change, so they are read once per application
+    and handed out without a query. The registry reloads itself when a name
+    is missing, after ROLE_REGISTRY_TTL seconds so other processes pick up
+    admin edits, and whenever `load` is called explicitly.
+
+    Example:
+    ```python
+    user.roles.append(role_registry['poster'])
+    ```
+    """
+    def _state(self):
+        return current_app.extensions.setdefault('role_registry', {'roles': None, 'loaded_at': 0})
+
+    def load(self):
+        """
+        Read every role from the database.
+
+        Returns:
+        - dict: The role rows keyed by name.
+        """
+        rows = db.session.execute(db.select(Role.id, Role.name, Role.description)).all()
+        state = self._state()
+        state['roles'] = {row.name: row for row in rows}
+        state['loaded_at'] = time.monotonic()
+        return state['roles']
+
+    def roles(self):
+        state = self._state()
+        if state['roles'] is None or \
+                time.monotonic() - state['loaded_at'] > current_app.config.get('ROLE_REGISTRY_TTL', 300):
+            return self.load()
+        return state['roles']
+
+    def get(self, name):
+        """
+        Resolve a role by name without querying the database.
+
+        Args:
+        - name (str): The role name.
+
+        Returns:
+        - Role: The role attached to the current session, or None if it does not exist.
+        """
+        row = self.roles().get(name)
+        if row is None:
+            row = self.load().get(name)
+        if row is None:
+            return None
+        role = Role(row.name)
+        role.id = row.id
+        role.description = row.description
+        make_transient_to_detached(role)
+        return db.session.merge(role, load=False)
+
+    def __getitem__(self, name):
+        role = self.get(name)
+        if role is None:
+            raise KeyError(name)
+        return role
+
+
+role_registry = RoleRegistry()
+
+
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+def reset_role_names(target, value, initiator):
+    """
+    Forget the resolved role names when the user's roles change.
+    """
+    target._role_names = None
+
+
+@event.listens_for(User, 'expire')
+def reset_role_names_on_expire(target, attrs):
+    # The target is None when the instance was garbage collected
+    if target is not None and (attrs is None or 'roles' in attrs):
+        target._role_names = None
+
+
+def fan_out_limit():
+    """
+    The follower count above which an author's posts are fanned out on read.
+    """
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', 1000)
+
+
+def fan_out_posts(connection, posts):
+    """
+    Copy new posts into the timelines of their authors and their followers.
+
+    Args:
+    - connection: The connection of the transaction writing the posts.
+    - posts (list): One dict per post with `post_id`, `user_id` and `publish_date`.
+    """
+    params = [
+        {'b_user_id': post['user_id'], 'b_publish_date': post['publish_date'], 'b_post_id': post['post_id']}
+        for post in posts if post['user_id'] is not None and post['publish_date'] is not None
+    ]
+    if not params:
+        return
+    connection.execute(timeline.insert().values(
+        user_id=bindparam('b_user_id'),
+        publish_date=bindparam('b_publish_date'),
+        post_id=bindparam('b_post_id')
+    ), params)
+    author_count = db.select(User.follower_count).where(User.id == bindparam('b_user_id')).scalar_subquery()
+    connection.execute(timeline.insert().from_select(
+        TIMELINE_COLUMNS,
+        db.select(
+            followers.c.follower_id,
+            bindparam('b_publish_date', type_=db.DateTime),
+            bindparam('b_post_id', type_=db.Integer)
+        ).where(followers.c.followed_id == bindparam('b_user_id'), author_count <= fan_out_limit())
+    ), params)
+
+
+def backfill_author(user_id, exclude=None):
+    """
+    Fan out every post of an author to the followers missing them.
+
+    Args:
+    - user_id (int): The author.
+    - exclude (int): A follower to leave out, e.g. one being removed.
+    """
+    missing = ~db.select(timeline.c.post_id).where(
+        timeline.c.user_id == followers.c.follower_id,
+        timeline.c.publish_date == Post.publish_date,
+        timeline.c.post_id == Post.id
+    ).exists()
+    query = db.select(followers.c.follower_id, Post.publish_date, Post.id).join(
+        Post, Post.user_id == followers.c.followed_id).where(
+        followers.c.followed_id == user_id, Post.publish_date.isnot(None), missing)
+    if exclude is not None:
+        query = query.where(followers.c.follower_id != exclude)
+    db.session.execute(timeline.insert().from_select(TIMELINE_COLUMNS, query))
+
+
+@event.listens_for(db.session, 'before_flush')
+def remove_deleted_posts_from_timeline(session, flush_context, instances):
+    """
+    Delete the timeline rows of posts about to be deleted, before the posts
+    themselves so the foreign key is never left dangling.
+    """
+    post_ids = [post.id for post in session.deleted if isinstance(post, Post) and post.id is not None]
+    if post_ids:
+        session.connection().execute(timeline.delete().where(timeline.c.post_id.in_(post_ids)))
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_timeline(session, flush_context):
+    """
+    Fan out the posts inserted by this flush and move the timeline rows of
+    posts whose publish date changed.
+
+    Posts that gain or lose their publish date, or change author, have their
+    rows deleted and fanned out again, and so do posts whose previous date is
+    unknown; fan_out_posts skips undated posts.
+    """
+    new_posts = [
+        {'post_id': post.id, 'user_id': post.user_id, 'publish_date': post.publish_date}
+        for post in session.new if isinstance(post, Post)
+    ]
+    moved = []
+    refanned = []
+    for post in session.dirty:
+        if not isinstance(post, Post):
+            continue
+        dates = attributes.get_history(post, 'publish_date', passive=attributes.PASSIVE_NO_INITIALIZE)
+        authors = attributes.get_history(post, 'user_id', passive=attributes.PASSIVE_NO_INITIALIZE)
+        # The old value is unknown when the attribute was expired before being set
+        if authors.has_changes() or (dates.has_changes() and (
+                not dates.deleted or None in dates.deleted or post.publish_date is None)):
+            refanned.append(post)
+        elif dates.has_changes():
+            moved.append({'b_post_id': post.id, 'b_publish_date': post.publish_date})
+    if refanned:
+        session.connection().execute(
+            timeline.delete().where(timeline.c.post_id.in_([post.id for post in refanned]))
+        )
+        new_posts += [
+            {'post_id': post.id, 'user_id': post.user_id, 'publish_date': post.publish_date}
+            for post in refanned
+        ]
+    if new_posts:
+        fan_out_posts(session.connection(), new_posts)
+    if moved:
+        session.connection().execute(
+            timeline.update().where(timeline.c.post_id == bindparam('b_post_id'))
+            .values(publish_date=bindparam('b_publish_date')),
+            moved
+        )
+
+
+def rebuild_timeline():
+    """
+    Recount followers and rebuild the timeline table from posts and followers.
+
+    Used to backfill the table on databases created before it existed, or
+    after TIMELINE_FANOUT_LIMIT changed.
+    """
+    users = User.__table__
+    count = db.select(db.func.count()).where(followers.c.followed_id == users.c.id).scalar_subquery()
+    db.session.execute(users.update().values(follower_count=count))
+    db.session.execute(timeline.delete())
+    db.session.execute(timeline.insert().from_select(
+        TIMELINE_COLUMNS,
+        db.select(Post.user_id, Post.publish_date, Post.id).where(
+            Post.user_id.isnot(None), Post.publish_date.isnot(None))
+    ))
+    db.session.execute(timeline.insert().from_select(
+        TIMELINE_COLUMNS,
+        db.select(followers.c.follower_id, Post.publish_date, Post.id)
+        .join(Post, Post.user_id == followers.c.followed_id)
+        .join(User, User.id == followers.c.followed_id)
+        .where(Post.publish_date.isnot(None), User.follower_count <= fan_out_limit())
+    ))
+    db.session.commit()
@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import bcrypt
+from .. import db
+
+log = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    """
+    Raised when too many password checks are already waiting for a worker.
+    """
+
+
+def hash_rounds(pwhash):
+    """
+    Read the cost factor out of a bcrypt hash.
+
+    Args:
+    - pwhash (str or bytes): A hash such as '$2b$12$...'.
+
+    Returns:
+    - int: The log rounds, or None if the hash cannot be parsed.
+    """
+    if isinstance(pwhash, bytes):
+        pwhash = pwhash.decode('utf-8')
+    try:
+        return int(pwhash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt on a small dedicated thread pool.
+
+    bcrypt costs tens of milliseconds of CPU per call, so a burst of logins
+    would otherwise occupy every request thread. At most BCRYPT_WORKERS
+    hashes run at once; once BCRYPT_QUEUE_LIMIT calls are waiting, new ones
+    fail fast with HasherBusy. The counters in `metrics()` show how deep the
+    queue gets.
+
+    Example:
+    ```python
+    if password_hasher.check(user, password):
+        login_user(user)
+    ```
+    """
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['password_hasher'] = self
+
+    def _executor(self):
+        # Pools do not survive a fork, so each worker process gets its own
+        if self.executor is None or self.pid != os.getpid():
+            with self.lock:
+                if self.executor is None or self.pid != os.getpid():
+                    self.executor = ThreadPoolExecutor(
+                        max_workers=self.app.config.get('BCRYPT_WORKERS', 4),
+                        thread_name_prefix='bcrypt'
+                    )
+                    self.pid = os.getpid()
+        return self.executor
+
+    def run(self, fn, *args):
+        """
+        Run a bcrypt call on the pool and wait for its result.
+
+        Raises:
+        - HasherBusy: If the queue is full.
+        """
+        with self.lock:
+            if self.queued >= self.app.config.get('BCRYPT_QUEUE_LIMIT', 64):
+                self.rejected += 1
+                raise HasherBusy()
+            self.queued += 1
+        submitted = time.monotonic()
+
+        def task():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_seconds += time.monotonic() - submitted
+            try:
+                return fn(*args)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return self._executor().submit(task).result()
+
+    def hash(self, password):
+        """
+        Hash a password with the configured BCRYPT_LOG_ROUNDS.
+        """
+        return self.run(bcrypt.generate_password_hash, password, self.app.config.get('BCRYPT_LOG_ROUNDS', 12))
+
+    def check(self, user, password):
+        """
+        Check a user's password, rehashing it when it was stored with a
+        different cost than BCRYPT_LOG_ROUNDS.
+
+        Args:
+        - user (User): The user signing in.
+        - password (str): The password they typed.
+
+        Returns:
+        - bool: True if the password matches.
+
+        Raises:
+        - HasherBusy: If the queue is full.
+        """
+        if not user.password or not self.run(bcrypt.check_password_hash, user.password, password):
+            return False
+        if hash_rounds(user.password) != self.app.config.get('BCRYPT_LOG_ROUNDS', 12):
+            try:
+                user.password = self.hash(password)
+                db.session.commit()
+            except HasherBusy:
+                pass
+            except Exception as e:
+                log.error("Failed to rehash password of user %s: %s" % (user.id, e))
+                db.session.rollback()
+        return True
+
+    def metrics(self):
+        """
+        Returns:
+        - dict: Calls waiting and running now, and totals since startup.
+        """
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_seconds': self.wait_seconds,
+            }
+
+
+password_hasher = PasswordHasher()
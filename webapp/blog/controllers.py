@@ -1,4 +1,6 @@
 import datetime
+import hashlib
+from urllib.parse import urlencode
 from flask import (render_template,
                     Blueprint, 
                     flash, 
@@ -7,16 +9,19 @@ from flask import (render_template,
                     current_app, 
                     abort, 
                     request, 
-                    get_flashed_messages, 
                     session,
                     g)
 from flask_login import login_required, current_user
-from .models import db, Post, Tag, Comment
+from .models import db, Post, Tag, Comment, tags as post_tags, add_tags_to_post, resolve_tags, posts_modified
 
 from .forms import CommentForm, PostForm
 from ..auth.models import User
 from ..auth import has_role
 from .. import cache
+from ..conditional import conditional, make_etag
+from ..compression import store_variants
+from .invalidation import dependency_versions
+from .search import search_posts
 from flask_babel import _, get_locale
 
 blog_blueprint = Blueprint(
@@ -26,6 +31,18 @@ blog_blueprint = Blueprint(
     url_prefix='/blog'
 )
 
+# Cached pages are evicted by invalidation hooks, the TTL is only a backstop
+VIEW_CACHE_TIMEOUT = 6 * 3600
+
+# Every page embeds the sidebar, so each one depends on it as well
+CACHE_DEPENDENCIES = {
+    'blog.home': lambda view_args: ['sidebar'],
+    'blog.followed_posts': lambda view_args: ['sidebar', 'followed/%s' % current_user.id],
+    'blog.post': lambda view_args: ['sidebar', 'post/%s' % view_args['post_id']],
+    'blog.posts_by_tag': lambda view_args: ['sidebar', 'tag/%s' % view_args['tag_name']],
+    'blog.posts_by_user': lambda view_args: ['sidebar', 'user/%s' % view_args['username']],
+}
+
 @blog_blueprint.before_request
 def before_request():
     """
@@ -38,29 +55,103 @@ def before_request():
     """
     g.locale = str(get_locale())
 
+def skip_cache():
+    """
+    Bypass the view cache for anything but GET requests.
+
+    Returns:
+    - bool: True if the response must not be cached.
+    """
+    return request.method != 'GET'
+
+def request_variant():
+    """
+    The parts of the current request a page depends on besides its data.
+
+    Returns:
+    - list: The cache namespace version, path, sorted query string, user and role names, locale and pending
+      flashed messages (peeked, not consumed), as strings.
+    """
+    query = urlencode(sorted(request.args.items(multi=True)))
+    messages = repr(session.get('_flashes', []))
+    if current_user.is_authenticated:
+        user = str(current_user.id)
+        roles = ','.join(sorted(current_user.role_names))
+    else:
+        user = ""
+        roles = ""
+    return [
+        str(current_app.config.get('CACHE_NAMESPACE_VERSION', 1)),
+        request.path,
+        query,
+        user,
+        roles,
+        session.get('locale', ''),
+        messages,
+    ]
+
 def make_cache_key(*args, **kwargs):
     """
     Generate a cache key for the current request.
 
-    This function creates a unique cache key based on request path, query parameters, user roles, locale, and flashed messages.
+    The key is identical across worker processes: it digests the request variant (see `request_variant`) and
+    the current version of every dependency of the view, so invalidating a dependency evicts the page. The
+    compressed variants of the page are cached under the same key.
 
     Args:
     - *args: Positional arguments.
     - **kwargs: Keyword arguments.
 
     Returns:
-    - bytes: A cache key encoded in UTF-8.
+    - str: A cache key prefixed with the endpoint name.
     """
-    path = request.path
-    args = str(hash(frozenset(request.args.items())))
-    messages = str(hash(frozenset(get_flashed_messages())))
-    if current_user.is_authenticated:
-        roles = str(current_user.roles)
-    else:
-        roles=""
-    return (path + args + roles + session.get('locale', '') + messages).encode('utf-8')
+    dependencies = CACHE_DEPENDENCIES.get(request.endpoint, lambda view_args: [])(request.view_args)
+    versions = ','.join(dependency_versions(dependencies))
+    parts = request_variant() + [versions]
+    digest = hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+    key = '%s/%s' % (request.endpoint, digest)
+    store_variants(key, VIEW_CACHE_TIMEOUT)
+    return key
+
+def page_validators(*stamps):
+    """
+    Compute the entity tag of a page from the stamps of its data.
 
-@cache.cached(timeout=7200, key_prefix="sidebar_data")
+    Pages also embed the sidebar and per-user parts that have no modification
+    time, so they only get an ETag, and no Last-Modified.
+
+    Args:
+    - *stamps: Values that change with the page's own data, see `posts_modified`.
+
+    Returns:
+    - tuple: The ETag and None.
+    """
+    recent, top_tags = sidebar_data()
+    sidebar = [(post.id, post.updated_at) for post in recent]
+    sidebar += [(tag.id, tag.title, tag.post_count) for tag in top_tags]
+    return make_etag(*request_variant(), sidebar, *stamps), None
+
+def post_validators(post_id):
+    count, updated_at = posts_modified(Post.id == post_id)
+    if not count:
+        return None
+    return page_validators(updated_at)
+
+def tag_validators(tag_name):
+    tag_id = db.session.execute(db.select(Tag.id).where(Tag.title == tag_name)).scalar()
+    if tag_id is None:
+        return None
+    return page_validators(tag_id, *posts_modified(
+        Post.id.in_(db.select(post_tags.c.post_id).where(post_tags.c.tag_id == tag_id))
+    ))
+
+def user_validators(username):
+    user_id = db.session.execute(db.select(User.id).where(User.username == username)).scalar()
+    if user_id is None:
+        return None
+    return page_validators(user_id, *posts_modified(Post.user_id == user_id))
+
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix="sidebar_data")
 def sidebar_data():
     """
     Retrieve data for the sidebar, including recent posts and top tags.
@@ -69,22 +160,13 @@ def sidebar_data():
     - Tuple: A tuple containing recent posts and top tags.
     """
     recent = Post.query.order_by(Post.publish_date.desc()).limit(5).all()
-    # Using a joined load to get the posts with their associated tags
-    posts_with_tags = Post.query.options(db.joinedload(Post.tags)).all()
-
-    # Counting the occurrences of each tag
-    tag_count = {}
-    for post in posts_with_tags:
-        for tag in post.tags:
-            tag_count[tag] = tag_count.get(tag, 0) + 1
-
-    # Getting the top tags based on the count
-    top_tags = sorted(tag_count.items(), key=lambda x: x[1], reverse=True)[:5]
+    # Tag.post_count is kept up to date on flush, so the top tags are a single indexed read
+    top_tags = Tag.query.filter(Tag.post_count > 0).order_by(Tag.post_count.desc()).limit(5).all()
     return recent, top_tags
 
 @blog_blueprint.route('/')
 @blog_blueprint.route('/home')
-@cache.cached(timeout=60)
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
 def home():
     """
     Display the home page with a list of recent posts and top tags.
@@ -101,7 +183,7 @@ def home():
 
 @blog_blueprint.route('/followed_posts')
 @login_required
-@cache.cached(timeout=60)
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
 def followed_posts():
     """
     Display posts of users followed by the current user.
@@ -116,6 +198,22 @@ def followed_posts():
 
     return render_template('home.html', posts=posts, recent=recent, top_tags=top_tags)
 
+@blog_blueprint.route('/search')
+def search():
+    """
+    Display the posts matching the 'q' query argument, ranked by relevance.
+
+    Returns:
+    - Flask response: Rendered search results page.
+    """
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    results = search_posts(query, page=max(page, 1), per_page=current_app.config.get('POSTS_PER_PAGE', 10))
+
+    recent, top_tags = sidebar_data()
+
+    return render_template('search.html', results=results, recent=recent, top_tags=top_tags)
+
 @blog_blueprint.route('/new_post', methods=['GET', 'POST'])
 @login_required
 @has_role('poster')
@@ -133,6 +231,7 @@ def new_post():
         new_post.user_id = current_user.id
         new_post.text = form.text.data
         new_post.publish_date = datetime.datetime.utcnow()
+        add_tags_to_post(new_post, form.tag_titles())
         db.session.add(new_post)
         db.session.commit()
         flash(_('Post added'), category='success')
@@ -159,16 +258,19 @@ def edit_post(id):
             post.title = form.title.data
             post.text = form.text.data
             post.publish_date = datetime.datetime.utcnow()
+            post.tags = resolve_tags(form.tag_titles())
             db.session.merge(post)
             db.session.commit()
             return redirect(url_for('.post', post_id=post.id))
         form.title.data = post.title
         form.text.data = post.text
+        form.tags.data = ', '.join(tag.title for tag in post.tags)
         return render_template('edit.html', form=form, post=post)
     abort(403)
 
 @blog_blueprint.route('/post/<int:post_id>', methods=['GET', 'POST'])
-@cache.cached(timeout=60, key_prefix=make_cache_key)
+@conditional(post_validators, private=True)
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
 def post(post_id):
     """
     Display a specific post, including comments.
@@ -200,7 +302,7 @@ def post(post_id):
     else:
         flash(_('Login to comment'), category='info')
     
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(db.undefer(Post.text_html)).get_or_404(post_id)
     tags = post.tags
     comments = post.comments.order_by(Comment.date.desc()).all()
     recent, top_tags = sidebar_data()
@@ -216,7 +318,8 @@ def post(post_id):
     )
 
 @blog_blueprint.route('/tag/<string:tag_name>')
-@cache.cached(timeout=60, key_prefix=make_cache_key)
+@conditional(tag_validators, private=True)
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
 def posts_by_tag(tag_name):
     """
     Display posts associated with a specific tag.
@@ -240,7 +343,8 @@ def posts_by_tag(tag_name):
     )
 
 @blog_blueprint.route('/user/<string:username>')
-@cache.cached(timeout=60, key_prefix=make_cache_key)
+@conditional(user_validators, private=True)
+@cache.cached(timeout=VIEW_CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
 def posts_by_user(username):
     """
     Display posts created by a specific user.
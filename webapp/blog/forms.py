@@ -14,4 +14,14 @@ class PostForm(FlaskForm):
         _l('Title'),
         [InputRequired(), Length(max=255)]
     )
-    text = TextAreaField(_l('Content'), [InputRequired()])
\ No newline at end of file
+    text = TextAreaField(_l('Content'), [InputRequired()])
+    tags = StringField(_l('Tags'), [Length(max=1000)])
+
+    def tag_titles(self):
+        """
+        Split the comma separated tags field into tag titles.
+
+        Returns:
+        - list: The non-empty titles, stripped of whitespace.
+        """
+        return [title.strip() for title in (self.tags.data or '').split(',') if title.strip()]
\ No newline at end of file
@@ -0,0 +1,128 @@
+import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+from .. import db, cache
+from .models import Post, Comment, Tag
+
+VERSION_KEY = 'version/%s'
+
+
+def new_version():
+    """
+    Generate a fresh version token for a cache dependency.
+
+    Returns:
+    - str: A short random token.
+    """
+    return uuid.uuid4().hex[:12]
+
+
+def dependency_versions(names):
+    """
+    Look up the current version token of each dependency in one round-trip.
+
+    Dependencies that have no version yet (or whose version was evicted) get a
+    new one, so an evicted version can never resurrect stale cache entries.
+
+    Args:
+    - names (list): Dependency names, e.g. ['post/1', 'sidebar'].
+
+    Returns:
+    - list: The version tokens, in the same order as `names`.
+    """
+    keys = [VERSION_KEY % name for name in names]
+    versions = list(cache.get_many(*keys))
+    for i, version in enumerate(versions):
+        if version is None:
+            version = new_version()
+            if not cache.add(keys[i], version, timeout=0):
+                version = cache.get(keys[i]) or version
+            versions[i] = version
+    return versions
+
+
+def invalidate(*names):
+    """
+    Evict every cached page that depends on the given names.
+
+    Pages embed the version of their dependencies in the cache key, so bumping
+    a version makes all matching entries unreachable without enumerating them.
+
+    Args:
+    - *names: Dependency names to invalidate.
+    """
+    if not names:
+        return
+    cache.set_many({VERSION_KEY % name: new_version() for name in names}, timeout=0)
+    if 'sidebar' in names:
+        cache.delete('sidebar_data')
+
+
+def invalidate_on_commit(*names):
+    """
+    Invalidate dependencies once the current transaction commits.
+
+    For writes that bypass the ORM (bulk Core inserts), which the flush
+    listeners below cannot see.
+
+    Args:
+    - *names: Dependency names to invalidate.
+    """
+    db.session.info.setdefault('cache_dependencies', set()).update(names)
+
+
+def _post_dependencies(post, history_passive):
+    dependencies = {'sidebar', 'post/%s' % post.id}
+    if post.user is not None:
+        dependencies.add('user/%s' % post.user.username)
+    history = attributes.get_history(post, 'tags', passive=history_passive)
+    for tag in list(history.added) + list(history.unchanged) + list(history.deleted):
+        dependencies.add('tag/%s' % tag.title)
+    return dependencies
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_cache_dependencies(session, flush_context):
+    """
+    Collect the cache dependencies touched by this flush.
+
+    The session still holds its pre-flush state here, so attribute history
+    tells us which tags a post gained or lost. The dependencies are only
+    invalidated once the transaction commits.
+    """
+    dependencies = session.info.setdefault('cache_dependencies', set())
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Post) and session.is_modified(obj):
+            dependencies |= _post_dependencies(obj, attributes.PASSIVE_NO_INITIALIZE)
+        elif isinstance(obj, Comment):
+            dependencies.add('post/%s' % obj.post_id)
+        elif isinstance(obj, Tag) and session.is_modified(obj):
+            history = attributes.get_history(obj, 'title')
+            for title in list(history.added) + list(history.unchanged) + list(history.deleted):
+                dependencies.add('tag/%s' % title)
+            dependencies.add('sidebar')
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            dependencies |= _post_dependencies(obj, attributes.PASSIVE_OFF)
+        elif isinstance(obj, Comment):
+            dependencies.add('post/%s' % obj.post_id)
+        elif isinstance(obj, Tag):
+            dependencies |= {'tag/%s' % obj.title, 'sidebar'}
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cache_dependencies(session):
+    """
+    Invalidate the dependencies collected since the last commit.
+    """
+    dependencies = session.info.pop('cache_dependencies', None)
+    if dependencies:
+        invalidate(*dependencies)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_cache_dependencies(session):
+    """
+    Forget the dependencies of a transaction that was rolled back.
+    """
+    session.info.pop('cache_dependencies', None)
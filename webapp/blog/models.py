@@ -1,10 +1,16 @@
 from .. import db
 import datetime
 from hashlib import sha256, md5
+from sqlalchemy import bindparam, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import attributes
+from .render import sanitize_html, strip_tags, make_excerpt
 tags = db.Table(
     'post_tags',
     db.Column('post_id', db.Integer, db.ForeignKey('post.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')),
+    db.UniqueConstraint('post_id', 'tag_id'),
+    db.Index('ix_post_tags_tag_id_post_id', 'tag_id', 'post_id')
 )
 
     
@@ -15,8 +21,13 @@ class Post(db.Model):
     Attributes:
     - id (int): Unique identifier for the post.
     - title (str): Title of the post.
-    - text (str): Content of the post.
+    - text (str): Content of the post, as submitted. Deferred.
+    - text_html (str): Sanitized HTML rendered on the post page. Deferred.
+    - text_plain (str): The text stripped of markup, served by the API. Deferred.
+    - excerpt (str): The first 500 characters of the plain text, shown in post lists.
     - publish_date (datetime): Date and time when the post was published.
+    - updated_at (datetime): Last change to anything the post's pages show: the post itself,
+      its tags or its comments. Bumped on flush, the HTTP validators derive from it.
     - user_id (int): ID of the user who created the post.
     - comments (relationship): Relationship to associated comments.
     - tags (relationship): Relationship to associated tags.
@@ -24,20 +35,58 @@ class Post(db.Model):
     Methods:
     - __init__(self, title=""): Initializes a new post with an optional title.
     - __repr__(self): Returns a string representation of the post.
+    - html, plain_text, summary: text_html, text_plain and excerpt, rendered from text when NULL.
     """
     id = db.Column(db.Integer(), primary_key=True)
     title = db.Column(db.String(255))
-    text = db.Column(db.Text())
-    publish_date = db.Column(db.DateTime())
+    text = db.deferred(db.Column(db.Text()))
+    text_html = db.deferred(db.Column(db.Text()))
+    text_plain = db.deferred(db.Column(db.Text()))
+    excerpt = db.Column(db.Text())
+    publish_date = db.Column(db.DateTime(), index=True)
+    updated_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow, index=True)
     user_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     tags = db.relationship('Tag', secondary=tags, backref=db.backref('posts', lazy='dynamic'))
 
+    __table_args__ = (
+        db.Index('ix_post_user_id_publish_date', 'user_id', 'publish_date'),
+    )
+
     def __init__(self, title=""):
         self.title = title
 
     def __repr__(self):
         return "<Post '{}'>".format(self.title)
+
+    @property
+    def html(self):
+        """
+        The sanitized HTML of the post, rendered on the fly (and the deferred
+        text loaded) for posts written before text_html existed, until
+        `flask render-text` backfills them.
+        """
+        if self.text_html is None:
+            return render_text(self.text)['text_html'] or ''
+        return self.text_html
+
+    @property
+    def plain_text(self):
+        """
+        The text stripped of markup, with the same fallback as `html`.
+        """
+        if self.text_plain is None:
+            return render_text(self.text)['text_plain']
+        return self.text_plain
+
+    @property
+    def summary(self):
+        """
+        The excerpt shown in post lists, with the same fallback as `html`.
+        """
+        if self.excerpt is None:
+            return render_text(self.text)['excerpt'] or ''
+        return self.excerpt
     
 class Comment(db.Model):
     """
@@ -47,23 +96,40 @@ class Comment(db.Model):
     - id (int): Unique identifier for the comment.
     - name (str): Name of the comment author.
     - text (str): Content of the comment.
+    - text_plain (str): The text stripped of markup, served by the API.
     - date (datetime): Date and time when the comment was created.
     - post_id (int): ID of the post associated with the comment.
     - user_id (int): ID of the user who created the comment.
 
     Methods:
     - __repr__(self): Returns a string representation of the comment.
+    - plain_text: text_plain, stripped from text when NULL.
     - avatar(self, size): Generates a Gravatar URL for the comment author's avatar.
     """
     id = db.Column(db.Integer(), primary_key=True)
     name = db.Column(db.String(255))
     text = db.Column(db.Text())
-    date = db.Column(db.DateTime())
+    text_plain = db.Column(db.Text())
+    date = db.Column(db.DateTime(), index=True)
     post_id = db.Column(db.Integer(), db.ForeignKey('post.id'))
     user_id = db.Column(db.Integer(), db.ForeignKey('user.id'))
 
+    __table_args__ = (
+        db.Index('ix_comment_post_id_date', 'post_id', 'date'),
+        db.Index('ix_comment_user_id_date', 'user_id', 'date'),
+    )
+
     def __repr__(self):
         return "<Comment '{}'>".format(self.text[:15])
+
+    @property
+    def plain_text(self):
+        """
+        text_plain, stripped on the fly for comments written before it existed.
+        """
+        if self.text_plain is None:
+            return strip_tags(self.text) if self.text is not None else None
+        return self.text_plain
     
     def avatar(self, size):
         digest = sha256(self.name.lower().encode('utf-8')).hexdigest()
@@ -78,16 +144,321 @@ class Tag(db.Model):
     Attributes:
     - id (int): Unique identifier for the tag.
     - title (str): Title or name of the tag.
+    - post_count (int): Number of posts carrying the tag, maintained on flush.
 
     Methods:
     - __init__(self, title=""): Initializes a new tag with an optional title.
     - __repr__(self): Returns a string representation of the tag.
     """
     id = db.Column(db.Integer(), primary_key=True)
-    title = db.Column(db.String(255))
+    title = db.Column(db.String(255), unique=True)
+    post_count = db.Column(db.Integer(), nullable=False, default=0, server_default='0', index=True)
 
     def __init__(self, title=""):
         self.title = title
 
     def __repr__(self):
-        return "<Tag '{}'>".format(self.title)
\ No newline at end of file
+        return "<Tag '{}'>".format(self.title)
+
+
+def insert_ignore(table):
+    """
+    Build an INSERT that skips rows conflicting with a unique constraint.
+
+    Args:
+    - table (Table): The table to insert into.
+
+    Returns:
+    - Insert: The statement for the session's database.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect in ('mysql', 'mariadb'):
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+
+def insert_rows(table, rows):
+    """
+    Insert rows with one executemany and return their ids in order.
+
+    SQLite cannot batch an ordered RETURNING, so there the ids are derived
+    instead: the table has no AUTOINCREMENT, every row gets max(id) + 1, and
+    the transaction holds the write lock from the first row on, so the new
+    rows are exactly the last len(rows) ids.
+
+    Args:
+    - table (Table): A table with an integer `id` primary key.
+    - rows (list): Column values, one dict per row.
+
+    Returns:
+    - list: The new ids, in the order of `rows`.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        result = connection.execute(table.insert().returning(table.c.id, sort_by_parameter_order=True), rows)
+        return [row[0] for row in result]
+    connection.execute(table.insert(), rows)
+    last = connection.execute(db.select(db.func.max(table.c.id))).scalar()
+    return list(range(last - len(rows) + 1, last + 1))
+
+
+def resolve_tags(titles):
+    """
+    Load the tags with the given titles, creating the missing ones.
+
+    Costs one SELECT ... IN, plus one bulk INSERT and one more SELECT when
+    some tags are new. Concurrent requests creating the same tag do not
+    conflict, because the insert skips titles that already exist.
+
+    Args:
+    - titles (list): Tag titles, duplicates are ignored.
+
+    Returns:
+    - list: The Tag objects, in the order of their first title.
+    """
+    titles = list(dict.fromkeys(title for title in titles if title))
+    if not titles:
+        return []
+    found = {tag.title: tag for tag in Tag.query.filter(Tag.title.in_(titles))}
+    missing = [title for title in titles if title not in found]
+    if missing:
+        db.session.execute(insert_ignore(Tag.__table__), [{'title': title} for title in missing])
+        found.update((tag.title, tag) for tag in Tag.query.filter(Tag.title.in_(missing)))
+    return [found[title] for title in titles if title in found]
+
+
+def add_tags_to_post(post, titles):
+    """
+    Attach tags to a post by title, skipping the ones it already has.
+
+    Args:
+    - post (Post): The post, new or persistent.
+    - titles (list): Tag titles.
+    """
+    attached = set(post.tags)
+    for tag in resolve_tags(titles):
+        if tag not in attached:
+            post.tags.append(tag)
+            attached.add(tag)
+
+
+def render_post_text(post, text):
+    """
+    Store the render artifacts derived from a post body.
+
+    Args:
+    - post (Post): The post being written.
+    - text (str): Its new body.
+    """
+    for key, value in render_text(text).items():
+        setattr(post, key, value)
+
+
+def render_text(text):
+    """
+    Derive the render artifacts of a post body.
+
+    Args:
+    - text (str): The post body.
+
+    Returns:
+    - dict: The text_html, text_plain and excerpt column values.
+    """
+    if text is None:
+        return {'text_html': None, 'text_plain': None, 'excerpt': None}
+    text_plain = strip_tags(text)
+    return {'text_html': sanitize_html(text), 'text_plain': text_plain, 'excerpt': make_excerpt(text_plain)}
+
+
+@event.listens_for(Post.text, 'set')
+def post_text_set(target, value, oldvalue, initiator):
+    render_post_text(target, value)
+
+
+@event.listens_for(Comment.text, 'set')
+def comment_text_set(target, value, oldvalue, initiator):
+    target.text_plain = strip_tags(value) if value is not None else None
+
+
+def render_existing_text(batch_size=500):
+    """
+    Backfill the render artifacts of posts and comments written before they existed.
+
+    Args:
+    - batch_size (int): Rows rendered and committed per batch.
+
+    Returns:
+    - tuple: The number of posts and comments rendered.
+    """
+    counts = []
+    for model in (Post, Comment):
+        last_id = 0
+        count = 0
+        while True:
+            batch = model.query.options(db.undefer(model.text)).filter(
+                model.id > last_id
+            ).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            for item in batch:
+                item.text = item.text
+            db.session.commit()
+            last_id = batch[-1].id
+            count += len(batch)
+        counts.append(count)
+    return tuple(counts)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_tag_count_changes(session, flush_context, instances):
+    """
+    Record how many post_tags rows each tag gains or loses in this flush.
+
+    New tags have no id yet, so the deltas are keyed by Tag instance and
+    applied in `apply_tag_count_changes` once the flush has assigned ids.
+    """
+    deltas = {}
+    for post in list(session.new) + list(session.dirty):
+        if not isinstance(post, Post):
+            continue
+        history = attributes.get_history(post, 'tags', passive=attributes.PASSIVE_NO_INITIALIZE)
+        for tag in history.added:
+            deltas[tag] = deltas.get(tag, 0) + 1
+        for tag in history.deleted:
+            deltas[tag] = deltas.get(tag, 0) - 1
+    for post in session.deleted:
+        if not isinstance(post, Post):
+            continue
+        history = attributes.get_history(post, 'tags')
+        for tag in list(history.unchanged) + list(history.deleted):
+            deltas[tag] = deltas.get(tag, 0) - 1
+    session.info['tag_count_deltas'] = deltas
+
+
+@event.listens_for(db.session, 'after_flush')
+def apply_tag_count_changes(session, flush_context):
+    """
+    Apply the recorded tag deltas with a single UPDATE statement.
+    """
+    deltas = session.info.pop('tag_count_deltas', {})
+    update_tag_counts(session.connection(), {
+        tag.id: delta
+        for tag, delta in deltas.items()
+        if tag.id is not None and tag not in session.deleted
+    })
+
+
+def update_tag_counts(connection, deltas):
+    """
+    Add deltas to Tag.post_count with a single UPDATE statement.
+
+    Args:
+    - connection: The connection of the transaction changing post_tags.
+    - deltas (dict): The change of each tag's count, keyed by tag id.
+    """
+    params = [{'tag_id': tag_id, 'delta': delta} for tag_id, delta in deltas.items() if delta]
+    if not params:
+        return
+    table = Tag.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.id == bindparam('tag_id'))
+        .values(post_count=table.c.post_count + bindparam('delta')),
+        params
+    )
+
+
+def recount_tags():
+    """
+    Recompute every Tag.post_count from the post_tags table.
+
+    Used to backfill the counter on databases created before it existed.
+    """
+    table = Tag.__table__
+    count = db.select(db.func.count()).where(tags.c.tag_id == table.c.id).scalar_subquery()
+    db.session.execute(table.update().values(post_count=count))
+    db.session.commit()
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_touched_posts(session, flush_context, instances):
+    """
+    Bump Post.updated_at for every change a post's pages show.
+
+    Edited posts (including their tags) are stamped directly. Comments and
+    renamed or deleted tags only know the ids of their posts, which are
+    stamped with one UPDATE in `apply_touched_posts` instead of being loaded.
+    """
+    now = datetime.datetime.utcnow()
+    post_ids = set()
+    tag_ids = set()
+    for obj in session.dirty:
+        if isinstance(obj, Post) and session.is_modified(obj):
+            obj.updated_at = now
+        elif isinstance(obj, Tag) and obj.id is not None and session.is_modified(obj):
+            tag_ids.add(obj.id)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Comment):
+            history = attributes.get_history(obj, 'post_id')
+            post_ids.update(list(history.added) + list(history.unchanged) + list(history.deleted))
+            post = obj.__dict__.get('post')
+            if post is not None and post.id is not None:
+                post_ids.add(post.id)
+    tag_ids.update(obj.id for obj in session.deleted if isinstance(obj, Tag) and obj.id is not None)
+    if tag_ids:
+        # Read now, deleting a tag also deletes its post_tags rows
+        post_ids.update(session.execute(db.select(tags.c.post_id).where(tags.c.tag_id.in_(tag_ids))).scalars())
+    post_ids.discard(None)
+    session.info['touched_posts'] = (post_ids, now)
+
+
+@event.listens_for(db.session, 'after_flush')
+def apply_touched_posts(session, flush_context):
+    post_ids, now = session.info.pop('touched_posts', (set(), None))
+    touch_posts(session.connection(), post_ids, now)
+
+
+def touch_posts(connection, post_ids, now=None):
+    """
+    Set Post.updated_at of several posts with a single UPDATE statement.
+
+    Args:
+    - connection: The connection of the transaction changing the posts.
+    - post_ids (iterable): The ids of the posts.
+    - now (datetime): The timestamp, the current UTC time by default.
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    table = Post.__table__
+    connection.execute(
+        table.update().where(table.c.id.in_(post_ids))
+        .values(updated_at=now or datetime.datetime.utcnow())
+    )
+
+
+def posts_modified(*criteria):
+    """
+    Count the posts matching `criteria` and find their last change,
+    without loading them.
+
+    Together the two values change whenever the set of posts or any of them
+    does: edits raise the maximum and removals lower the count. Posts written
+    before updated_at existed fall back to their publish date.
+
+    Args:
+    - *criteria: Filters on Post, none for every post.
+
+    Returns:
+    - tuple: The number of posts and the latest datetime, None without posts.
+    """
+    statement = db.select(
+        db.func.count(Post.id),
+        db.func.max(db.func.coalesce(Post.updated_at, Post.publish_date))
+    ).where(*criteria)
+    count, updated_at = db.session.execute(statement).one()
+    return count, updated_at
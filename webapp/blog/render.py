@@ -0,0 +1,135 @@
+from html import escape
+from html.parser import HTMLParser
+
+# Tags and attributes a post body may keep once sanitized
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'div', 'em', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'li', 'ol', 'p', 'pre', 's',
+    'span', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'th', 'thead',
+    'tr', 'u', 'ul'
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title'},
+    'abbr': {'title'},
+    'img': {'src', 'alt', 'title'},
+}
+URL_ATTRIBUTES = {'href', 'src'}
+ALLOWED_SCHEMES = ('http:', 'https:', 'mailto:')
+VOID_TAGS = {'br', 'hr', 'img'}
+# Elements dropped together with everything inside them
+DROPPED_TAGS = {'script', 'style', 'iframe', 'object', 'embed'}
+
+EXCERPT_LENGTH = 500
+
+
+class HTMLStripper(HTMLParser):
+    fed = list()
+
+    def __init__(self):
+        self.reset()
+        self.convert_charrefs = True
+        self.fed = []
+
+    def handle_data(self, d):
+        self.fed.append(d)
+
+    def get_data(self):
+        return ''.join(self.fed)
+
+
+def strip_tags(html):
+    s = HTMLStripper()
+    s.feed(html)
+
+    return s.get_data()
+
+
+class HTMLSanitizer(HTMLParser):
+    """
+    Rebuild HTML keeping only allowlisted tags and attributes.
+
+    Text is re-escaped, unknown tags are dropped while their text is kept, and
+    the content of script-like elements is dropped entirely.
+    """
+    def __init__(self):
+        super(HTMLSanitizer, self).__init__(convert_charrefs=True)
+        self.out = []
+        self.open_tags = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        parts = [tag]
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in URL_ATTRIBUTES and ':' in value.split('/', 1)[0] \
+                    and not value.lower().startswith(ALLOWED_SCHEMES):
+                continue
+            parts.append('%s="%s"' % (name, escape(value)))
+        self.out.append('<%s>' % ' '.join(parts))
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in self.open_tags and tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.out.append('</%s>' % open_tag)
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(escape(data, quote=False))
+
+    def get_html(self):
+        return ''.join(self.out) + ''.join('</%s>' % tag for tag in reversed(self.open_tags))
+
+
+def sanitize_html(html):
+    """
+    Sanitize user supplied HTML so it can be rendered with `| safe`.
+
+    Args:
+    - html (str): The raw HTML.
+
+    Returns:
+    - str: The sanitized HTML.
+    """
+    sanitizer = HTMLSanitizer()
+    sanitizer.feed(html)
+    sanitizer.close()
+    return sanitizer.get_html()
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH, end='...', leeway=5):
+    """
+    Shorten plain text on a word boundary, like Jinja's `truncate` filter.
+
+    Args:
+    - text (str): The plain text.
+    - length (int): The maximum length of the excerpt.
+    - end (str): Appended when the text was shortened.
+    - leeway (int): Texts at most this much longer than `length` are kept whole.
+
+    Returns:
+    - str: The excerpt.
+    """
+    if len(text) <= length + leeway:
+        return text
+    return text[:length - len(end)].rsplit(' ', 1)[0] + end
@@ -0,0 +1,150 @@
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm import selectinload
+from .. import db
+from .models import Post
+
+# External content FTS5 index over post titles and plain text bodies, kept in
+# sync by triggers so every write path (ORM, bulk inserts, raw SQL) updates it.
+# SQLite only.
+FTS_TABLE = 'post_fts'
+
+CREATE_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "title, text_plain, content='post', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts(rowid, title, text_plain) VALUES (new.id, new.title, new.text_plain); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, title, text_plain) VALUES ('delete', old.id, old.title, old.text_plain); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, text_plain ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, title, text_plain) VALUES ('delete', old.id, old.title, old.text_plain); "
+    "INSERT INTO post_fts(rowid, title, text_plain) VALUES (new.id, new.title, new.text_plain); "
+    "END",
+]
+
+DROP_STATEMENTS = [
+    "DROP TRIGGER IF EXISTS post_fts_insert",
+    "DROP TRIGGER IF EXISTS post_fts_delete",
+    "DROP TRIGGER IF EXISTS post_fts_update",
+    "DROP TABLE IF EXISTS post_fts",
+]
+
+for statement in CREATE_STATEMENTS:
+    event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in DROP_STATEMENTS:
+    event.listen(Post.__table__, 'before_drop', DDL(statement).execute_if(dialect='sqlite'))
+
+# Title matches weigh ten times more than body matches
+SEARCH_STATEMENT = text(
+    "SELECT rowid, snippet(post_fts, -1, :open, :close, :ellipsis, 24) "
+    "FROM post_fts WHERE post_fts MATCH :match "
+    "ORDER BY bm25(post_fts, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+)
+COUNT_STATEMENT = text("SELECT count(*) FROM post_fts WHERE post_fts MATCH :match")
+
+# Control characters cannot appear in posts, so they safely mark the hits
+# until the snippet has been escaped.
+HIT_OPEN = '\x02'
+HIT_CLOSE = '\x03'
+
+
+def match_expression(query):
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    Every word is quoted so user input can never be parsed as FTS5 syntax;
+    the words are implicitly ANDed.
+
+    Args:
+    - query (str): The text typed by the user.
+
+    Returns:
+    - str: The MATCH expression, empty if the query has no words.
+    """
+    return ' '.join('"%s"' % word.replace('"', '""') for word in query.split())
+
+
+def highlight(snippet):
+    """
+    Escape a snippet and wrap its hits in <mark> tags.
+
+    Args:
+    - snippet (str): A snippet delimited with HIT_OPEN and HIT_CLOSE.
+
+    Returns:
+    - Markup: HTML safe snippet.
+    """
+    html = str(escape(snippet))
+    return Markup(html.replace(HIT_OPEN, '<mark>').replace(HIT_CLOSE, '</mark>'))
+
+
+class SearchResults(object):
+    """
+    One page of search results.
+
+    Attributes:
+    - query (str): The text searched for.
+    - page (int): The current page number.
+    - per_page (int): The number of results per page.
+    - total (int): The number of matching posts.
+    - items (list): (Post, snippet) tuples ranked by bm25.
+    """
+    def __init__(self, query, page, per_page, total, items):
+        self.query = query
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.items = items
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page * self.per_page < self.total
+
+
+def search_posts(query, page=1, per_page=10):
+    """
+    Full-text search over post titles and plain text bodies.
+
+    Args:
+    - query (str): The text to search for.
+    - page (int): The page number, starting at 1.
+    - per_page (int): The number of results per page.
+
+    Returns:
+    - SearchResults: The requested page of results.
+    """
+    match = match_expression(query)
+    if not match:
+        return SearchResults(query, page, per_page, 0, [])
+    total = db.session.execute(COUNT_STATEMENT, {'match': match}).scalar()
+    rows = db.session.execute(SEARCH_STATEMENT, {
+        'open': HIT_OPEN,
+        'close': HIT_CLOSE,
+        'ellipsis': '…',
+        'match': match,
+        'limit': per_page,
+        'offset': (page - 1) * per_page,
+    }).all()
+    # The API serializes the tags of every result, loaded here in one query
+    posts = Post.query.options(db.undefer(Post.text_plain), selectinload(Post.tags)).filter(
+        Post.id.in_([row[0] for row in rows])
+    )
+    posts = {post.id: post for post in posts}
+    items = [(posts[id], highlight(snippet)) for id, snippet in rows if id in posts]
+    return SearchResults(query, page, per_page, total, items)
+
+
+def rebuild_index():
+    """
+    Recreate the FTS5 table and triggers and reindex every post.
+    """
+    for statement in DROP_STATEMENTS + CREATE_STATEMENTS:
+        db.session.execute(text(statement))
+    db.session.execute(text("INSERT INTO post_fts(post_fts) VALUES ('rebuild')"))
+    db.session.commit()
@@ -1,15 +1,13 @@
 import logging
 import click
-from faker import Faker
 from .auth import bcrypt
-from .blog.models import Tag, Post, Comment
-from .auth.models import User, Role, db
-import random
+from .blog.models import recount_tags, render_existing_text
+from .auth.models import User, Role, db, rebuild_timeline, role_registry
+from .export import EXPORTS, export_chunks
+from .testdata import DataGenerator
 
 log = logging.getLogger(__name__)
 
-faker = Faker()
-
 fake_users = [
     {'username': 'user_default', 'role': 'default'},
     {'username': 'user_poster', 'role': 'poster'},
@@ -18,36 +16,6 @@ fake_users = [
 
 fake_roles = ['default', 'poster', 'admin']
 
-def generate_tags(n):
-    """
-    Generate a list of tags with random names.
-
-    Args:
-        n (int): The number of tags to generate.
-
-    Returns:
-        list: A list of Tag objects.
-
-    This function generates a list of tags with random names and stores them in the database.
-    """
-    tags = list()
-    for i in range(n):
-        tag_title = faker.color_name()
-        tag = Tag.query.filter_by(title=tag_title).first()
-        if tag:
-            tags.append(tag)
-            continue
-        tag = Tag()
-        tag.title = tag_title
-        tags.append(tag)
-        try:
-            db.session.add(tag)
-            db.session.commit()
-        except Exception as e:
-            log.error("Failed to add tag %s: %s" % (str(tag), e))
-            db.session.rollback()
-    return tags
-
 def generate_roles():
     """
     Generate roles from a predefined list of role names.
@@ -59,7 +27,7 @@ def generate_roles():
     """
     roles = list()
     for rolename in fake_roles:
-        role = Role.query.filter_by(name=rolename).first()
+        role = role_registry.get(rolename)
         if role:
             roles.append(role)
             continue
@@ -82,7 +50,7 @@ def generate_users():
             users.append(user)
             continue
         user = User()
-        poster = Role.query.filter_by(name=item['role']).one_or_none()
+        poster = role_registry.get(item['role'])
         if poster is None:
             log.warning("Role not found: %s" % item['role'])
             continue
@@ -98,44 +66,6 @@ def generate_users():
             db.session.rollback()
     return users
 
-def generate_posts(n, users, tags):
-    posts = list()
-    for i in range(n):
-        post = Post()
-        post.title = faker.sentence()
-        post.text = faker.text(max_nb_chars=1000)
-        post.publish_date = faker.date_this_decade(before_today=True, after_today=False)
-        post.user_id = users[random.randrange(0, len(users))].id
-        post.tags = [tags[random.randrange(0, len(tags))] for i in range(0, 2)]
-
-
-        posts.append(post)
-        try:
-            db.session.add(post)
-            db.session.commit()
-        except Exception as e:
-            log.error("Fail to add post %s: %s" % (str(post), e))
-            db.session.rollback()
-    return posts
-
-def generate_comments(users, posts):
-    for post in posts:
-        num_comments = random.randint(1, 5)
-        for i in range(num_comments):
-
-            comment = Comment()
-            comment.name = users[random.randrange(0, len(users))].username
-            comment.text = faker.sentence()
-            comment.date = faker.date_this_decade(before_today=True, after_today=False)
-            comment.post_id = posts[random.randrange(0, 100)].id
-            try:
-                db.session.add(comment)
-                db.session.commit()
-            except Exception as e:
-                log.error('Failed to add comment %s: %s' % (str(comment), e))
-                db.session.rollback()
-
-
 def register(app):
     """
     Register custom command-line commands for the Flask application.
@@ -147,17 +77,110 @@ def register(app):
     """
 
     @app.cli.command('test-data')
-    def test_data():
+    @click.option('--users', default=10, help='Users to generate, besides the three fixed accounts')
+    @click.option('--posts', default=100, help='Posts to generate')
+    @click.option('--tags', default=5, help='Tags to generate')
+    @click.option('--comments', default=300, help='Comments to generate')
+    @click.option('--follows', default=50, help='Follow edges to generate')
+    @click.option('--skew', default=1.0, help='Zipf exponent of authors, followed users, tags and commented posts; 0 is uniform')
+    @click.option('--seed', type=int, help='Seed for reproducible data, random by default')
+    @click.option('--workers', type=int, help='Processes generating content, one per CPU by default')
+    @click.option('--batch', default=10000, help='Rows inserted per transaction')
+    def test_data(users, posts, tags, comments, follows, skew, seed, workers, batch):
         """
-        Generate test data for roles, users, posts, tags, and comments.
+        Generate test data for roles, users, posts, tags, comments and followers.
 
-        This command generates test data for roles, users, posts, tags, and comments and inserts it into the database.
+        Content is generated in a process pool and inserted in large batches,
+        so millions of rows take minutes. The same --seed gives the same data
+        on an empty database.
         """
         generate_roles()
-        users = generate_users()
-        tags = generate_tags(5)
-        posts = generate_posts(100, users, tags)
-        generate_comments(users, posts)
+        generate_users()
+        generator = DataGenerator(
+            users=users, posts=posts, tags=tags, comments=comments, follows=follows,
+            skew=skew, seed=seed, workers=workers, batch=batch, echo=click.echo
+        )
+        try:
+            generator.run()
+        except Exception as e:
+            log.error("Fail to generate test data Error: %s" % e)
+            db.session.rollback()
+
+    @app.cli.command('recount-tags')
+    def recount_tags_command():
+        """
+        Rebuild the denormalized Tag.post_count column from post_tags.
+        """
+        try:
+            recount_tags()
+            click.echo('Tag counts rebuilt.')
+        except Exception as e:
+            log.error("Fail to recount tags Error: %s" % e)
+            db.session.rollback()
+
+    @app.cli.command('rebuild-timeline')
+    def rebuild_timeline_command():
+        """
+        Recount followers and rebuild the timeline table behind followed_posts.
+        """
+        try:
+            rebuild_timeline()
+            click.echo('Timeline rebuilt.')
+        except Exception as e:
+            log.error("Fail to rebuild timeline Error: %s" % e)
+            db.session.rollback()
+
+    @app.cli.command('export')
+    @click.argument('name', type=click.Choice(sorted(EXPORTS)))
+    @click.option('--output', '-o', type=click.File('wb'), default='-', help='File to write, stdout by default')
+    @click.option('--gzip', 'compress', is_flag=True, help='Gzip the output')
+    def export(name, output, compress):
+        """
+        Stream posts, comments or users as NDJSON.
+        """
+        try:
+            for chunk in export_chunks(name, gzip=compress):
+                output.write(chunk)
+        except Exception as e:
+            log.error("Fail to export %s Error: %s" % (name, e))
+            db.session.rollback()
+
+    @app.cli.command('explain-queries')
+    def explain_queries():
+        """
+        Print the query plan of every hot query and flag full table scans.
+        """
+        from .explain import explain_hot_queries, full_scans
+        for name, plan in explain_hot_queries().items():
+            scans = full_scans(plan)
+            click.echo('%s%s' % (name, ' [FULL SCAN]' if scans else ''))
+            for row in plan:
+                click.echo('    %s' % row)
+
+    @app.cli.command('search-index')
+    def search_index():
+        """
+        Create the full-text search index if missing and reindex every post.
+        """
+        from .blog.search import rebuild_index
+        try:
+            rebuild_index()
+            click.echo('Search index rebuilt.')
+        except Exception as e:
+            log.error("Fail to rebuild search index Error: %s" % e)
+            db.session.rollback()
+
+    @app.cli.command('render-text')
+    def render_text():
+        """
+        Backfill the sanitized HTML, excerpt and plain text of existing posts and comments.
+        """
+        try:
+            posts, comments = render_existing_text()
+            click.echo('Rendered {0} posts and {1} comments.'.format(posts, comments))
+        except Exception as e:
+            log.error("Fail to render text Error: %s" % e)
+            db.session.rollback()
 
     @app.cli.command('create_user')
     @click.argument('username')
@@ -178,7 +201,7 @@ def register(app):
     @click.argument('username')
     @click.argument('password')
     def create_admin(username, password):
-        admin_role = Role.query.filter_by(name='admin').scalar()
+        admin_role = role_registry.get('admin')
         user = User()
         user.username = username
         user.set_password(password)
@@ -194,9 +217,11 @@ def register(app):
     @app.cli.command('list-users')
     def list_users():
         try:
-            users = User.query.all()
-            for user in users:
-                click.echo('{0}'.format(user.username))
+            usernames = db.session.execute(
+                db.select(User.username).order_by(User.id).execution_options(yield_per=1000, stream_results=True)
+            ).scalars()
+            for username in usernames:
+                click.echo('{0}'.format(username))
         except Exception as e:
             log.error("Fail to list users Error: %s" % e)
             db.session.rollback()
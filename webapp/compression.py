@@ -0,0 +1,160 @@
+import gzip
+from flask import current_app, g, request
+from . import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings we can produce, preferred first when the client rates them equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+VARIANT_KEY = 'compressed/%s/%s'
+
+
+def compress(data, encoding, config):
+    """
+    Args:
+    - data (bytes): The response body.
+    - encoding (str): 'br' or 'gzip'.
+    - config (Config): The app config, for the compression levels.
+
+    Returns:
+    - bytes: The encoded body.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=config.get('COMPRESS_BR_LEVEL', 5))
+    # A fixed mtime keeps the output, and so the cached variant, deterministic
+    return gzip.compress(data, compresslevel=config.get('COMPRESS_LEVEL', 6), mtime=0)
+
+
+def negotiate(accept_encodings):
+    """
+    Pick the encoding of a response from the request's Accept-Encoding.
+
+    Args:
+    - accept_encodings (MIMEAccept): `request.accept_encodings`.
+
+    Returns:
+    - str: The best encoding the client accepts, or None for identity.
+    """
+    best = None
+    quality = 0
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding] > quality:
+            best, quality = encoding, accept_encodings[encoding]
+    return best
+
+
+def selected_encoding():
+    """
+    Returns:
+    - str: The encoding negotiated for the current request, or None for
+      identity and when compression is off.
+    """
+    if not current_app.config.get('COMPRESS', True):
+        return None
+    return negotiate(request.accept_encodings)
+
+
+def encoded_etag(etag, encoding):
+    """
+    Returns:
+    - str: The entity tag of the representation sent with `encoding`.
+    """
+    return '%s-%s' % (etag, encoding) if encoding else etag
+
+
+def select_representation(response, encoding):
+    """
+    Label a response, a 200 or a 304, as the representation for `encoding`:
+    vary on Accept-Encoding and append the encoding to the ETag.
+
+    The tag only depends on the negotiated encoding, not on whether the body
+    ends up compressed (bodies under COMPRESS_MIN_SIZE are not), so a 304
+    carries the same tag as the 200 it stands for without knowing the body.
+
+    Args:
+    - response (Response): The response.
+    - encoding (str): The negotiated encoding, None for identity.
+    """
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and encoding:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+
+
+def store_variants(key, timeout):
+    """
+    Mark the current response as the body of a view cache entry, so its
+    encoded variants are cached next to it under the same key and lifetime.
+    The key embeds the versions of the page's dependencies, so the variants
+    are invalidated with the page.
+
+    Args:
+    - key (str): The view cache key.
+    - timeout (int): The view cache timeout.
+    """
+    g.view_cache = (key, timeout)
+
+
+class Compression(object):
+    """
+    Compresses text responses with gzip, or brotli when the brotli package is
+    installed, according to the request's Accept-Encoding.
+
+    Responses under COMPRESS_MIN_SIZE bytes, streamed responses, and responses
+    that already have a Content-Encoding (such as the gzipped export) are sent
+    as they are. Pages from the view cache (see `store_variants`) keep their
+    encoded bodies in the cache as well, so a cache hit sends precompressed
+    bytes. Responses get the negotiated encoding appended to their ETag (see
+    `select_representation`), and `conditional.is_fresh` only matches the tag
+    of the encoding the request would get.
+
+    Example:
+    ```python
+    compression.init_app(app)
+    ```
+    """
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['compression'] = self
+        if app.config.get('COMPRESS', True):
+            app.after_request(self.after_request)
+
+    def compressible(self, response):
+        return (
+            request.method in ('GET', 'HEAD')
+            and response.status_code == 200
+            and response.mimetype in self.app.config.get('COMPRESS_MIMETYPES', ())
+            and not response.direct_passthrough
+            and not response.is_streamed
+            and 'Content-Encoding' not in response.headers
+            and not response.cache_control.no_transform
+        )
+
+    def after_request(self, response):
+        if not self.compressible(response):
+            return response
+        encoding = selected_encoding()
+        select_representation(response, encoding)
+        if encoding is None or len(response.get_data()) < self.app.config.get('COMPRESS_MIN_SIZE', 500):
+            return response
+        key, timeout = g.get('view_cache', (None, None))
+        data = None
+        if key is not None:
+            key = VARIANT_KEY % (encoding, key)
+            data = cache.get(key)
+        if data is None:
+            data = compress(response.get_data(), encoding, self.app.config)
+            if key is not None:
+                cache.set(key, data, timeout=timeout)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+compression = Compression()
@@ -0,0 +1,152 @@
+import datetime
+import hashlib
+from functools import wraps
+from flask import after_this_request, current_app, request, make_response
+from .compression import encoded_etag, select_representation, selected_encoding
+
+
+def make_etag(*parts):
+    """
+    Build a strong entity tag from the values a representation depends on.
+
+    Args:
+    - *parts: Values with a stable repr, e.g. ids and timestamps.
+
+    Returns:
+    - str: The tag, unquoted.
+    """
+    return hashlib.sha256('\x1f'.join(repr(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+def http_date(value):
+    """
+    Returns:
+    - datetime: A naive UTC datetime as an aware one, truncated to the
+      second resolution of HTTP dates.
+    """
+    return value.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+
+
+def is_fresh(etag, last_modified=None):
+    """
+    Whether the client's copy still matches, per the request's
+    If-None-Match or, without one, If-Modified-Since header.
+
+    Args:
+    - etag (str): The current entity tag.
+    - last_modified (datetime): The current modification time, naive UTC.
+
+    Returns:
+    - bool: True if a 304 can be sent instead of the representation.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if request.if_none_match:
+        # Only the copy encoded the way this request would get it matches
+        return request.if_none_match.contains_weak(encoded_etag(etag, selected_encoding()))
+    if last_modified is not None and request.if_modified_since is not None:
+        return http_date(last_modified) <= request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, last_modified=None, private=False):
+    """
+    Add the ETag and Last-Modified headers to a response, and ask clients to
+    revalidate their copy before every reuse.
+
+    Args:
+    - response (Response): The response.
+    - etag (str): The entity tag.
+    - last_modified (datetime): The modification time, naive UTC.
+    - private (bool): If the representation differs between users.
+
+    Returns:
+    - Response: The same response.
+    """
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = http_date(last_modified)
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response
+
+
+def not_modified(etag, last_modified=None, private=False):
+    """
+    Returns:
+    - Response: An empty 304 response carrying the validators, labelled like
+      the 200 it stands for.
+    """
+    response = set_validators(current_app.response_class(status=304), etag, last_modified, private)
+    select_representation(response, selected_encoding())
+    return response
+
+
+def revalidate(etag, last_modified=None, private=False):
+    """
+    For views that compute their validators themselves, such as API resources.
+
+    Args:
+    - etag (str): The current entity tag.
+    - last_modified (datetime): The current modification time, naive UTC.
+    - private (bool): If the representation differs between users.
+
+    Returns:
+    - Response: A 304 to return if the client's copy matches. None otherwise,
+      and the validators are added to the response if it succeeds.
+    """
+    if is_fresh(etag, last_modified):
+        return not_modified(etag, last_modified, private)
+
+    @after_this_request
+    def add_validators(response):
+        if response.status_code == 200:
+            set_validators(response, etag, last_modified, private)
+        return response
+    return None
+
+
+def conditional(validator, private=False):
+    """
+    Answer conditional GET requests to a view without running it.
+
+    `validator` is called with the view arguments and returns the entity tag
+    and modification time of the representation, computed from cheap
+    queries; if the client's copy matches, a 304 is sent before the view
+    (and the view cache) is reached. Otherwise the view runs and its
+    successful responses get the validators. A validator returning None
+    skips both, e.g. when the view is about to answer 404.
+
+    Example:
+    ```python
+    @blog_blueprint.route('/post/<int:post_id>')
+    @conditional(post_validators, private=True)
+    @cache.cached(...)
+    def post(post_id):
+    ```
+
+    Args:
+    - validator (function): Maps the view arguments to (etag, last_modified).
+    - private (bool): If the representation differs between users.
+
+    Returns:
+    - function: The decorator.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            validators = validator(**kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+            etag, last_modified = validators
+            if is_fresh(etag, last_modified):
+                return not_modified(etag, last_modified, private)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified, private)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+from . import db
+from .blog.models import Post, Comment, Tag, tags
+from .auth.models import User, followers
+
+# The statements behind the busiest pages and API endpoints, with sample ids
+# standing in for the request arguments.
+HOT_QUERIES = {
+    'home': lambda: db.select(Post).order_by(Post.publish_date.desc()).limit(10),
+    'sidebar_top_tags': lambda: db.select(Tag).where(Tag.post_count > 0).order_by(Tag.post_count.desc()).limit(5),
+    'post_comments': lambda: db.select(Comment).where(Comment.post_id == 1).order_by(Comment.date.desc()),
+    'tag_by_title': lambda: db.select(Tag).where(Tag.title == 'tag'),
+    'posts_by_tag': lambda: db.select(Post).join(tags, tags.c.post_id == Post.id).where(
+        tags.c.tag_id == 1).order_by(Post.publish_date.desc()),
+    'user_by_username': lambda: db.select(User).where(User.username == 'user'),
+    'posts_by_user': lambda: db.select(Post).where(Post.user_id == 1).order_by(Post.publish_date.desc()),
+    'comments_by_user': lambda: db.select(Comment).where(Comment.user_id == 1).order_by(Comment.date.desc()),
+    'comments_feed': lambda: db.select(Comment).order_by(Comment.date.desc(), Comment.id.desc()).limit(10),
+    'is_following': lambda: db.select(db.func.count()).select_from(followers).where(
+        followers.c.follower_id == 1, followers.c.followed_id == 2),
+    'followers_of_user': lambda: db.select(followers.c.follower_id).where(followers.c.followed_id == 1),
+    'followed_posts': lambda: User.followed_posts(SimpleNamespace(id=1)).limit(10).statement,
+}
+
+
+def explain(statement):
+    """
+    Run the database's query planner over a statement.
+
+    Args:
+        statement: A SQLAlchemy selectable.
+
+    Returns:
+        list: One string per plan row.
+    """
+    engine = db.engine
+    compiled = statement.compile(dialect=engine.dialect)
+    if engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(prefix + compiled.string, params).fetchall()
+    return [str(row[-1]) for row in rows]
+
+
+def full_scans(plan):
+    """
+    Pick the plan rows that read a whole table without an index.
+
+    Args:
+        plan (list): The rows returned by `explain`.
+
+    Returns:
+        list: The offending rows.
+    """
+    return [
+        row for row in plan
+        if row.startswith('SCAN ') and ' USING ' not in row and row.split()[1] in db.metadata.tables
+    ]
+
+
+def explain_hot_queries():
+    """
+    Explain every statement in HOT_QUERIES.
+
+    Returns:
+        dict: The plan rows of each query, keyed by query name.
+    """
+    return {name: explain(build()) for name, build in HOT_QUERIES.items()}
@@ -0,0 +1,103 @@
+import json
+import zlib
+from flask_restful import fields
+from sqlalchemy.orm import selectinload
+from . import db
+from .blog.models import Post, Comment
+from .auth.models import User
+from .api.blog.controllers import post_serializer, comment_serializer
+from .api.blog.serializers import Serializer
+
+# Rows fetched per round-trip; the ORM only holds one batch at a time
+EXPORT_BATCH_SIZE = 1000
+# Bytes of NDJSON gathered before a chunk is written or sent
+CHUNK_SIZE = 64 * 1024
+
+user_fields = {
+    'id': fields.Integer(),
+    'username': fields.String(),
+    'about_me': fields.String(),
+    'last_seen': fields.DateTime(dt_format='iso8601'),
+    'follower_count': fields.Integer(),
+}
+user_serializer = Serializer(user_fields)
+
+# The statement and serializer of each exportable table. Posts and comments
+# use the API representation.
+EXPORTS = {
+    'posts': (
+        lambda: db.select(Post).options(db.undefer(Post.text_plain), selectinload(Post.tags)).order_by(Post.id),
+        post_serializer
+    ),
+    'comments': (lambda: db.select(Comment).order_by(Comment.id), comment_serializer),
+    'users': (lambda: db.select(User).order_by(User.id), user_serializer),
+}
+
+
+def export_lines(name):
+    """
+    Stream a table as NDJSON.
+
+    Rows are fetched EXPORT_BATCH_SIZE at a time with a server-side cursor
+    where the database supports one, so memory does not grow with the table.
+
+    Args:
+        name (str): A key of EXPORTS.
+
+    Returns:
+        generator: One JSON document per row, each ending with a newline.
+    """
+    build, serializer = EXPORTS[name]
+    statement = build().execution_options(yield_per=EXPORT_BATCH_SIZE, stream_results=True)
+    for obj in db.session.execute(statement).scalars():
+        yield json.dumps(serializer.serialize(obj)) + '\n'
+
+
+def chunked(lines, size=CHUNK_SIZE):
+    """
+    Join lines into chunks of about `size` bytes.
+
+    Returns:
+        generator: UTF-8 encoded chunks.
+    """
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def gzipped(chunks, level=6):
+    """
+    Compress a stream of chunks into a single gzip member.
+
+    Returns:
+        generator: Compressed chunks.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(name, gzip=False):
+    """
+    Stream a table as NDJSON chunks ready to be written or sent.
+
+    Args:
+        name (str): A key of EXPORTS.
+        gzip (bool): Compress the stream.
+
+    Returns:
+        generator: Bytes.
+    """
+    chunks = chunked(export_lines(name))
+    return gzipped(chunks) if gzip else chunks
@@ -0,0 +1,307 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from flask import request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# Collapses expanded IN lists, so `IN (?, ?)` and `IN (?, ?, ?)` share a shape
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+# Shapes remembered before the memo is reset
+SHAPE_CACHE_SIZE = 2000
+# Distinct statements whose totals are kept for the admin dashboard
+MAX_STATEMENTS = 500
+
+_shapes = {}
+# Set for the duration of a request; a context variable is much cheaper to
+# read than flask.g, and the SQL listeners read it on every statement
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def statement_shape(statement):
+    """
+    Normalize a SQL statement so repeated executions of the same query
+    compare equal whatever their parameters.
+
+    Args:
+    - statement (str): The statement as sent to the driver.
+
+    Returns:
+    - str: The statement with IN lists collapsed to a single placeholder.
+    """
+    shape = _shapes.get(statement)
+    if shape is None:
+        if len(_shapes) >= SHAPE_CACHE_SIZE:
+            _shapes.clear()
+        shape = _shapes[statement] = IN_LIST.sub('(?)', statement)
+    return shape
+
+
+def shape_memo_size():
+    return len(_shapes)
+
+
+class RequestStats(object):
+    """
+    What one request spent in SQL, the cache and templates.
+    """
+    __slots__ = ('started', 'sql_count', 'sql_time', 'shapes', 'shape_times', 'cache_hits', 'cache_misses',
+                 'cache_sets', 'template_time', 'template_starts')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.shapes = Counter()
+        self.shape_times = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_sets = 0
+        self.template_time = 0.0
+        self.template_starts = []
+
+    def repeated(self, threshold):
+        """
+        Returns:
+        - list: (shape, count) of the statements run at least `threshold` times.
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+class StatementTotals(object):
+    """
+    Executions and time of every statement shape since the process started,
+    merged in once per request.
+    """
+    def __init__(self, limit=MAX_STATEMENTS):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.dropped = 0
+
+    def add(self, stats):
+        with self.lock:
+            for shape, count in stats.shapes.items():
+                total = self.totals.get(shape)
+                if total is None:
+                    if len(self.totals) >= self.limit:
+                        self.dropped += count
+                        continue
+                    total = self.totals[shape] = [0, 0.0]
+                total[0] += count
+                total[1] += stats.shape_times.get(shape, 0.0)
+
+    def top(self, n=20):
+        """
+        Returns:
+        - list: (shape, executions, seconds) of the n statements with the most total time.
+        """
+        with self.lock:
+            rows = [(shape, count, seconds) for shape, (count, seconds) in self.totals.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:n]
+
+    def __len__(self):
+        return len(self.totals)
+
+
+statement_totals = StatementTotals()
+
+
+def current_stats():
+    """
+    Returns:
+    - RequestStats: The stats of the current request, or None outside one.
+    """
+    return _request_stats.get()
+
+
+def start_stats():
+    """
+    Start accounting for the current request.
+
+    Returns:
+    - RequestStats: The new stats.
+    """
+    stats = RequestStats()
+    _request_stats.set(stats)
+    return stats
+
+
+def stop_stats():
+    _request_stats.set(None)
+
+
+class CacheRecorder(object):
+    """
+    Wraps a cache backend to count the hits, misses and sets of the current
+    request, including those of the `cache.cached` and `cache.memoize`
+    decorators, which talk to the backend directly. Functions appended to
+    `observers` are called with (operation, key, hit) for every key.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.observers = []
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def record(self, operation, key, hit=None):
+        stats = current_stats()
+        if stats is not None:
+            if operation == 'set':
+                stats.cache_sets += 1
+            elif hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+        for observer in self.observers:
+            observer(operation, key, hit)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        self.record('get', key, value is not None)
+        return value
+
+    def get_many(self, *keys):
+        values = list(self.backend.get_many(*keys))
+        for key, value in zip(keys, values):
+            self.record('get', key, value is not None)
+        return values
+
+    def set(self, key, value, timeout=None):
+        self.record('set', key)
+        return self.backend.set(key, value, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        self.record('set', key)
+        return self.backend.add(key, value, timeout=timeout)
+
+    def set_many(self, mapping, timeout=None):
+        for key in mapping:
+            self.record('set', key)
+        return self.backend.set_many(mapping, timeout=timeout)
+
+
+def record_cache_operations(app):
+    """
+    Wrap the app's cache backends in a CacheRecorder, once.
+
+    Returns:
+    - list: The recorders.
+    """
+    caches = app.extensions.get('cache', {})
+    for cache, backend in list(caches.items()):
+        if not isinstance(backend, CacheRecorder):
+            caches[cache] = CacheRecorder(backend)
+    return list(caches.values())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+    duration = time.perf_counter() - started.pop()
+    shape = statement_shape(statement)
+    stats.sql_time += duration
+    stats.sql_count += 1
+    stats.shapes[shape] += 1
+    stats.shape_times[shape] = stats.shape_times.get(shape, 0.0) + duration
+
+
+class RequestInstrumentation(object):
+    """
+    Always-on, low overhead accounting of every request.
+
+    Counts and times SQL statements, counts cache hits, misses and sets, and
+    times template rendering. Each response gets a Server-Timing header and
+    one JSON log line on the `webapp.instrumentation` logger. Statements run
+    N_PLUS_ONE_THRESHOLD times or more in one request, typically lazy loads
+    inside a loop, are listed in the line, which is then logged as a warning.
+
+    Example:
+    ```python
+    instrumentation.init_app(app)
+    ```
+    """
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['instrumentation'] = self
+        if not app.config.get('REQUEST_INSTRUMENTATION', True):
+            return
+        record_cache_operations(app)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+
+    def before_request(self):
+        start_stats()
+
+    def teardown_request(self, exc):
+        stop_stats()
+
+    def before_render_template(self, sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None:
+            stats.template_starts.append(time.perf_counter())
+
+    def template_rendered(self, sender, template, context, **extra):
+        stats = current_stats()
+        if stats is not None and stats.template_starts:
+            stats.template_time += time.perf_counter() - stats.template_starts.pop()
+
+    def after_request(self, response):
+        stats = current_stats()
+        stop_stats()
+        if stats is None:
+            return response
+        total = time.perf_counter() - stats.started
+        statement_totals.add(stats)
+        if self.app.config.get('SERVER_TIMING', True):
+            response.headers['Server-Timing'] = ', '.join([
+                'sql;dur=%.1f;desc="%d queries"' % (stats.sql_time * 1000, stats.sql_count),
+                'cache;desc="%d hits %d misses %d sets"' % (stats.cache_hits, stats.cache_misses, stats.cache_sets),
+                'tpl;dur=%.1f' % (stats.template_time * 1000),
+                'total;dur=%.1f' % (total * 1000),
+            ])
+        if request.endpoint == 'static':
+            return response
+        repeated = stats.repeated(self.app.config.get('N_PLUS_ONE_THRESHOLD', 5))
+        level = logging.WARNING if repeated else logging.INFO
+        if log.isEnabledFor(level):
+            log.log(level, json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'duration_ms': round(total * 1000, 2),
+                'sql_count': stats.sql_count,
+                'sql_ms': round(stats.sql_time * 1000, 2),
+                'cache_hits': stats.cache_hits,
+                'cache_misses': stats.cache_misses,
+                'cache_sets': stats.cache_sets,
+                'template_ms': round(stats.template_time * 1000, 2),
+                'n_plus_one': [{'statement': shape, 'count': count} for shape, count in repeated],
+            }))
+        return response
+
+
+instrumentation = RequestInstrumentation()
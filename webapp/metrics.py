@@ -0,0 +1,398 @@
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+from flask import Response, abort, current_app, g, request
+from . import db
+from .instrumentation import current_stats, start_stats, stop_stats, record_cache_operations
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Distinct cache key prefixes tracked before the rest are counted as 'other'
+MAX_CACHE_PREFIXES = 50
+# Seconds between two copies of the pool and bcrypt state into the shared file
+SYNC_INTERVAL = 1.0
+
+FILE_PATTERN = 'metrics-%d.db'
+HEADER = struct.Struct('<q')
+KEY_LENGTH = struct.Struct('<i')
+VALUE = struct.Struct('<d')
+
+
+class ValueFile(object):
+    """
+    The metric values of one process, in a memory-mapped file.
+
+    Each process only ever writes its own file, so updates need no locking
+    between processes, and a lock held for a few hundred nanoseconds between
+    threads. /metrics reads the files of every process and sums them. The
+    file is a used-size header followed by (key length, key, value) records
+    appended as new series appear; values are updated in place.
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.positions = {}
+        if path is None:
+            self.map = mmap.mmap(-1, self.INITIAL_SIZE)
+            self.used = HEADER.size
+            HEADER.pack_into(self.map, 0, self.used)
+            return
+        self.file = open(path, 'a+b')
+        size = max(os.fstat(self.file.fileno()).st_size, self.INITIAL_SIZE)
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.used = HEADER.unpack_from(self.map, 0)[0] or HEADER.size
+        # A restarted process may reuse the pid; carry on with its counts
+        for key, offset, value in read_records(self.map, self.used):
+            self.positions[tuple(key.split('\x1f'))] = offset
+
+    def _append(self, key):
+        encoded = '\x1f'.join(key).encode('utf-8')
+        padded = (KEY_LENGTH.size + len(encoded) + 7) // 8 * 8
+        needed = self.used + padded + VALUE.size
+        if needed > len(self.map):
+            self._grow(needed)
+        KEY_LENGTH.pack_into(self.map, self.used, len(encoded))
+        self.map[self.used + KEY_LENGTH.size:self.used + KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self.used + padded
+        VALUE.pack_into(self.map, offset, 0.0)
+        self.used = needed
+        # Readers only look as far as the header, so publish the record last
+        HEADER.pack_into(self.map, 0, self.used)
+        self.positions[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = len(self.map)
+        while size < needed:
+            size *= 2
+        if self.path is None:
+            grown = mmap.mmap(-1, size)
+            grown[:self.used] = self.map[:self.used]
+        else:
+            self.file.truncate(size)
+            grown = mmap.mmap(self.file.fileno(), size)
+        self.map.close()
+        self.map = grown
+
+    def inc(self, key, amount):
+        with self.lock:
+            offset = self.positions.get(key)
+            if offset is None:
+                offset = self._append(key)
+            VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    def set(self, key, value):
+        with self.lock:
+            offset = self.positions.get(key)
+            if offset is None:
+                offset = self._append(key)
+            VALUE.pack_into(self.map, offset, value)
+
+    def items(self):
+        with self.lock:
+            return [(key, value) for key, offset, value in read_records(self.map, self.used)]
+
+
+def read_records(data, used=None):
+    """
+    Parse a value file.
+
+    Returns:
+    - generator: (key, offset of the value, value) of every record.
+    """
+    if used is None:
+        used = HEADER.unpack_from(data, 0)[0]
+    position = HEADER.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        key = bytes(data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length]).decode('utf-8')
+        offset = position + (KEY_LENGTH.size + length + 7) // 8 * 8
+        yield key, offset, VALUE.unpack_from(data, offset)[0]
+        position = offset + VALUE.size
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric(object):
+    """
+    A named family of series, one per combination of label values.
+
+    `live` gauges describe a running process, e.g. its in-flight requests,
+    and are dropped from the sum once that process has exited.
+    """
+    def __init__(self, registry, name, help, type, labels=(), live=False):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(labels)
+        self.live = live
+        registry.families[name] = self
+
+    def inc(self, *values, amount=1.0):
+        self.registry.store().inc((self.name,) + values, amount)
+
+    def set(self, *values, value):
+        self.registry.store().set((self.name,) + values, value)
+
+    def samples(self, values):
+        """
+        Returns:
+        - list: (sample name, labels dict, value) in exposition order.
+        """
+        return [
+            (self.name, dict(zip(self.labels, key[1:])), value)
+            for key, value in sorted(values.items()) if key[0] == self.name
+        ]
+
+
+class Histogram(Metric):
+    """
+    Counts observations into buckets, stored non-cumulative so an observation
+    costs one update instead of one per bucket.
+    """
+    def __init__(self, registry, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help, 'histogram', labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *values):
+        store = self.registry.store()
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        store.inc((self.name,) + values + (str(index),), 1.0)
+        store.inc((self.name + '_sum',) + values, value)
+
+    def samples(self, values):
+        series = {}
+        for key, value in values.items():
+            if key[0] == self.name:
+                series.setdefault(key[1:-1], [0.0] * len(self.buckets))[int(key[-1])] += value
+        samples = []
+        for labels, counts in sorted(series.items()):
+            base = dict(zip(self.labels, labels))
+            total = 0.0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((self.name + '_bucket', dict(base, le=le), total))
+            samples.append((self.name + '_sum', base, values.get((self.name + '_sum',) + labels, 0.0)))
+            samples.append((self.name + '_count', base, total))
+        return samples
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels.items()
+    )
+    return '{%s}' % ','.join(escaped)
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else '%d' % value
+
+
+class Metrics(object):
+    """
+    Process-shared application metrics, served at /metrics in the
+    Prometheus text format.
+
+    With METRICS_DIR set, each process writes its own memory-mapped file in
+    that directory and /metrics sums the files of every process, so any
+    worker answers for the whole server. Clear the directory when the
+    server starts. Without it, the values live in anonymous memory and
+    cover the current process only. Set METRICS_TOKEN to require
+    `Authorization: Bearer <token>`.
+
+    Example:
+    ```python
+    metrics.init_app(app)
+    ```
+    """
+    def __init__(self):
+        self.directory = None
+        self.files = {}
+        self.families = {}
+        self.prefixes = set()
+        self.synced = 0.0
+        self.requests = Metric(self, 'flask_http_requests_total', 'Requests handled.', 'counter',
+                               ('endpoint', 'method', 'status'))
+        self.latency = Histogram(self, 'flask_http_request_duration_seconds', 'Request latency.', ('endpoint',))
+        self.in_flight = Metric(self, 'flask_http_requests_in_flight', 'Requests being handled.', 'gauge', live=True)
+        self.sql_queries = Metric(self, 'flask_sql_queries_total', 'SQL statements run by requests.', 'counter',
+                                  ('endpoint',))
+        self.sql_seconds = Metric(self, 'flask_sql_duration_seconds_total', 'Time requests spent in SQL.',
+                                  'counter', ('endpoint',))
+        self.cache = Metric(self, 'flask_cache_operations_total', 'Cache hits, misses and sets by key prefix.',
+                            'counter', ('prefix', 'result'))
+        self.pool = Metric(self, 'db_pool_connections', 'Database pool connections by state.', 'gauge',
+                           ('state',), live=True)
+        self.bcrypt_pending = Metric(self, 'bcrypt_pending', 'Password hashes waiting or running.', 'gauge',
+                                     ('state',), live=True)
+        self.bcrypt_calls = Metric(self, 'bcrypt_calls_total', 'Password hashes completed or rejected as busy.',
+                                   'counter', ('result',))
+        self.bcrypt_wait = Metric(self, 'bcrypt_wait_seconds_total', 'Time password hashes waited for a worker.',
+                                  'counter')
+
+    def init_app(self, app):
+        self.directory = app.config.get('METRICS_DIR')
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        app.extensions['metrics'] = self
+        # Installed by the request instrumentation too, but metrics do not depend on it
+        for recorder in record_cache_operations(app):
+            if self.record_cache not in recorder.observers:
+                recorder.observers.append(self.record_cache)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def store(self):
+        """
+        Returns:
+        - ValueFile: The values of the current process, opened after a fork.
+        """
+        pid = os.getpid()
+        store = self.files.get(pid)
+        if store is None:
+            path = os.path.join(self.directory, FILE_PATTERN % pid) if self.directory else None
+            store = self.files.setdefault(pid, ValueFile(path))
+        return store
+
+    def before_request(self):
+        g.metrics_in_flight = True
+        self.in_flight.inc()
+        if current_stats() is None:
+            # REQUEST_INSTRUMENTATION is off, count this request's SQL ourselves
+            start_stats()
+            g.metrics_stats = True
+
+    def after_request(self, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        self.requests.inc(endpoint, request.method, str(response.status_code))
+        self.latency.observe(time.perf_counter() - stats.started, endpoint)
+        if stats.sql_count:
+            self.sql_queries.inc(endpoint, amount=stats.sql_count)
+            self.sql_seconds.inc(endpoint, amount=stats.sql_time)
+        return response
+
+    def teardown_request(self, exc):
+        if g.pop('metrics_in_flight', False):
+            self.in_flight.inc(amount=-1)
+        if g.pop('metrics_stats', False):
+            stop_stats()
+        now = time.monotonic()
+        if now - self.synced >= SYNC_INTERVAL:
+            self.synced = now
+            self.sync()
+
+    def sync(self):
+        """
+        Copy the state of the pool and the password hasher into the shared file.
+        """
+        pool = db.engine.pool
+        for state, method in (('checked_out', 'checkedout'), ('checked_in', 'checkedin'), ('size', 'size')):
+            # Only QueuePool reports its state; SQLite in memory uses a static pool
+            if hasattr(pool, method):
+                self.pool.set(state, value=getattr(pool, method)())
+        hasher = current_app.extensions.get('password_hasher')
+        if hasher is not None:
+            counts = hasher.metrics()
+            self.bcrypt_pending.set('queued', value=counts['queued'])
+            self.bcrypt_pending.set('running', value=counts['running'])
+            self.bcrypt_calls.set('completed', value=counts['completed'])
+            self.bcrypt_calls.set('rejected', value=counts['rejected'])
+            self.bcrypt_wait.set(value=counts['wait_seconds'])
+
+    def record_cache(self, operation, key, hit):
+        """
+        Count a cache operation under the prefix of its key, the part before
+        the first '/', e.g. 'blog.home' or 'sidebar_data'.
+        """
+        prefix = str(key).split('/', 1)[0]
+        if prefix not in self.prefixes:
+            if len(self.prefixes) >= MAX_CACHE_PREFIXES:
+                prefix = 'other'
+            else:
+                self.prefixes.add(prefix)
+        if operation == 'get':
+            result = 'hit' if hit else 'miss'
+        else:
+            result = operation
+        self.cache.inc(prefix, result)
+
+    def collect(self):
+        """
+        Sum the values of every process.
+
+        Returns:
+        - dict: Values keyed by (metric name, label values...).
+        """
+        if self.directory:
+            sources = []
+            for path in glob.glob(os.path.join(self.directory, FILE_PATTERN.replace('%d', '*'))):
+                pid = int(os.path.basename(path)[len('metrics-'):-len('.db')])
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if len(data) >= HEADER.size:
+                    sources.append((pid, [(key, value) for key, offset, value in read_records(data)]))
+        else:
+            sources = [(os.getpid(), self.store().items())]
+        totals = {}
+        for pid, items in sources:
+            alive = None
+            for key, value in items:
+                key = tuple(key.split('\x1f'))
+                family = self.families.get(key[0])
+                if family is not None and family.live:
+                    if alive is None:
+                        alive = pid_alive(pid)
+                    if not alive:
+                        continue
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def render(self):
+        """
+        Returns:
+        - str: Every metric in the Prometheus text format.
+        """
+        values = self.collect()
+        lines = []
+        for family in self.families.values():
+            lines.append('# HELP %s %s' % (family.name, family.help))
+            lines.append('# TYPE %s %s' % (family.name, family.type))
+            for name, labels, value in family.samples(values):
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def view(self):
+        token = current_app.config.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != 'Bearer %s' % token:
+            abort(401)
+        self.sync()
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
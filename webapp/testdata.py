@@ -0,0 +1,321 @@
+import datetime
+import itertools
+import random
+import time
+from multiprocessing import Pool
+from faker import Faker
+from . import db, cache
+from .auth import bcrypt
+from .auth.models import User, roles, followers, rebuild_timeline, role_registry
+from .blog.models import (Post, Comment, tags, insert_ignore, insert_rows, resolve_tags, render_text, touch_posts,
+                          update_tag_counts)
+from .blog.render import strip_tags
+
+# Items generated per worker task
+CHUNK_SIZE = 1000
+# Tags attached to each generated post
+TAGS_PER_POST = 2
+# Generated posts and comments are dated between these, in UTC, so a seed
+# gives the same dates whenever it runs
+START = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+END = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+_worker = {}
+
+
+def skewed_weights(n, skew):
+    """
+    Cumulative Zipf weights over n ranks, for random.choices.
+
+    Rank r is picked with a probability proportional to 1 / (r + 1) ** skew,
+    so a skew of 0 is uniform and larger values concentrate the picks on the
+    first ranks: a few prolific authors, popular posts and tags, and users
+    with many followers.
+
+    Args:
+    - n (int): The number of ranks.
+    - skew (float): The Zipf exponent.
+
+    Returns:
+    - list: The cumulative weights.
+    """
+    return list(itertools.accumulate(1.0 / (rank + 1) ** skew for rank in range(n)))
+
+
+def _init_worker(seed, skew, offset, users, posts, tags):
+    _worker.clear()
+    _worker.update(seed=seed, skew=skew, offset=offset, users=users, posts=posts, tags=tags, weights={}, fake=Faker())
+
+
+def _pick(rng, kind, k=1):
+    """
+    Pick k ranks of `kind` (users, posts or tags) with the configured skew.
+    """
+    n = _worker[kind]
+    weights = _worker['weights'].get(kind)
+    if weights is None:
+        weights = _worker['weights'][kind] = skewed_weights(n, _worker['skew'])
+    return rng.choices(range(n), cum_weights=weights, k=k)
+
+
+def _generate(task):
+    """
+    Generate one chunk of rows in a worker.
+
+    Each chunk seeds its own generators from the seed, its kind and its
+    index, so the output does not depend on the number of workers or on
+    which worker ran the chunk. Rows refer to users, posts and tags by rank;
+    the main process maps ranks to ids, and dates comments after their post.
+
+    Args:
+    - task (tuple): The kind ('users', 'posts' or 'comments'), the chunk index
+      and the number of rows.
+
+    Returns:
+    - list: One dict per row.
+    """
+    kind, index, count = task
+    rng = random.Random('%s:%s:%d' % (_worker['seed'], kind, index))
+    fake = _worker['fake']
+    fake.seed_instance(rng.getrandbits(64))
+    rows = []
+    for i in range(count):
+        if kind == 'users':
+            rows.append({
+                'username': '%s_%d' % (fake.user_name(), _worker['offset'] + index * CHUNK_SIZE + i),
+                'about_me': fake.sentence(nb_words=8)[:140],
+            })
+        elif kind == 'posts':
+            text = fake.text(max_nb_chars=1000)
+            row = {
+                'title': fake.sentence(),
+                'text': text,
+                'publish_date': fake.date_time_between_dates(START, END, datetime.timezone.utc).replace(tzinfo=None),
+                'user': _pick(rng, 'users')[0],
+                'tags': set(),
+            }
+            want = min(TAGS_PER_POST, _worker['tags'])
+            while len(row['tags']) < want:
+                row['tags'].update(_pick(rng, 'tags', want - len(row['tags'])))
+            row.update(render_text(text))
+            rows.append(row)
+        else:
+            text = fake.sentence()
+            rows.append({
+                'text': text,
+                'text_plain': strip_tags(text),
+                # How far between its post's publish date and END the comment is
+                'delay': rng.random(),
+                'user': rng.randrange(_worker['users']),
+                'post': _pick(rng, 'posts')[0],
+            })
+    return rows
+
+
+def _tasks(kind, n):
+    return [(kind, index, min(CHUNK_SIZE, n - start)) for index, start in enumerate(range(0, n, CHUNK_SIZE))]
+
+
+class DataGenerator(object):
+    """
+    Fills the database with synthetic users, tags, posts, comments and follow
+    edges, at any scale.
+
+    Faker content, and the rendering of post bodies, is generated in a
+    process pool; the main process inserts the rows with executemany in
+    transactions of `batch` rows. Derived data is written the way the bulk
+    post API writes it: render columns and post_tags rows with the posts,
+    Tag.post_count per batch, Post.updated_at with each batch of comments,
+    and the follower counts and timeline rebuilt once at the end. The same
+    seed gives the same data on an empty database.
+
+    Example:
+    ```python
+    DataGenerator(users=10000, posts=1000000, seed=1).run()
+    ```
+    """
+    def __init__(self, users=10, posts=100, tags=5, comments=300, follows=50, skew=1.0,
+                 seed=None, workers=None, batch=10000, echo=None):
+        self.users = users
+        self.posts = posts
+        self.tags = tags
+        self.comments = comments
+        self.follows = follows
+        self.skew = skew
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.workers = workers
+        self.batch = batch
+        self.echo = echo or (lambda message: None)
+        self.offset = 0
+        self.user_ids = []
+        self.usernames = []
+        self.tag_ids = []
+        self.post_ids = []
+        self.post_dates = []
+
+    def run(self):
+        """
+        Generate everything.
+
+        Returns:
+        - dict: The number of rows inserted in each table.
+        """
+        self.echo('Seed: %s' % self.seed)
+        counts = {
+            'users': self.generate_users(),
+            'tags': self.generate_tags(),
+            'follows': self.generate_follows(),
+            'posts': self.generate_posts(),
+            'comments': self.generate_comments(),
+        }
+        if counts['posts'] or counts['follows']:
+            started = time.monotonic()
+            rebuild_timeline()
+            self.echo('Rebuilt timeline in %.1fs' % (time.monotonic() - started))
+        # Pages of many users and tags changed at once
+        cache.clear()
+        return counts
+
+    def generate(self, kind, n):
+        """
+        Generate n rows of `kind` in the pool, in order.
+
+        Returns:
+        - generator: Lists of rows, one per chunk.
+        """
+        initargs = (self.seed, self.skew, self.offset, len(self.user_ids), len(self.post_ids), len(self.tag_ids))
+        if self.workers is not None and self.workers <= 1:
+            _init_worker(*initargs)
+            yield from map(_generate, _tasks(kind, n))
+            return
+        with Pool(self.workers, _init_worker, initargs) as pool:
+            yield from pool.imap(_generate, _tasks(kind, n))
+
+    def batches(self, kind, n):
+        """
+        Regroup the generated chunks into transactions of `batch` rows.
+        """
+        started = time.monotonic()
+        done = 0
+        batch = []
+        for rows in self.generate(kind, n):
+            batch.extend(rows)
+            if len(batch) >= self.batch:
+                yield batch
+                done += len(batch)
+                batch = []
+                self.echo('%s: %d/%d' % (kind, done, n))
+        if batch:
+            yield batch
+            done += len(batch)
+        if n:
+            elapsed = time.monotonic() - started
+            self.echo('%s: %d in %.1fs (%d/s)' % (kind, done, elapsed, done / max(elapsed, 1e-6)))
+
+    def generate_users(self):
+        password = bcrypt.generate_password_hash('password')
+        role_id = role_registry['default'].id
+        # Usernames end with a number past every existing id, so reruns do not collide
+        self.offset = (db.session.execute(db.select(db.func.max(User.id))).scalar() or 0) + 1
+        for batch in self.batches('users', self.users):
+            for row in batch:
+                row['password'] = password
+            ids = insert_rows(User.__table__, batch)
+            db.session.execute(roles.insert(), [{'user_id': id, 'role_id': role_id} for id in ids])
+            db.session.commit()
+        users = db.session.execute(db.select(User.id, User.username).order_by(User.id)).all()
+        self.user_ids = [id for id, username in users]
+        self.usernames = [username for id, username in users]
+        return self.users
+
+    def generate_tags(self):
+        fake = Faker()
+        fake.seed_instance(self.seed)
+        titles = []
+        seen = set()
+        while len(titles) < self.tags:
+            title = fake.color_name()
+            if title in seen:
+                title = '%s %d' % (title, len(titles))
+            seen.add(title)
+            titles.append(title)
+        self.tag_ids = [tag.id for tag in resolve_tags(titles)]
+        db.session.commit()
+        return len(self.tag_ids)
+
+    def generate_follows(self):
+        """
+        Insert follow edges from uniformly picked followers to skewed picks of
+        followed users, so a few users get most of the followers.
+        """
+        if len(self.user_ids) < 2 or not self.follows:
+            return 0
+        rng = random.Random('%s:follows' % self.seed)
+        weights = skewed_weights(len(self.user_ids), self.skew)
+        limit = len(self.user_ids) * (len(self.user_ids) - 1)
+        edges = set()
+        while len(edges) < min(self.follows, limit):
+            follower = self.user_ids[rng.randrange(len(self.user_ids))]
+            followed = self.user_ids[rng.choices(range(len(self.user_ids)), cum_weights=weights)[0]]
+            if follower != followed:
+                edges.add((follower, followed))
+        statement = insert_ignore(followers)
+        edges = sorted(edges)
+        for start in range(0, len(edges), self.batch):
+            db.session.execute(statement, [
+                {'follower_id': follower, 'followed_id': followed}
+                for follower, followed in edges[start:start + self.batch]
+            ])
+            db.session.commit()
+        self.echo('follows: %d' % len(edges))
+        return len(edges)
+
+    def generate_posts(self):
+        if not self.user_ids:
+            return 0
+        for batch in self.batches('posts', self.posts):
+            rows = []
+            for row in batch:
+                row = dict(row, user_id=self.user_ids[row['user']])
+                del row['user'], row['tags']
+                rows.append(row)
+            ids = insert_rows(Post.__table__, rows)
+            links = []
+            deltas = {}
+            for post_id, row in zip(ids, batch):
+                for rank in row['tags']:
+                    links.append({'post_id': post_id, 'tag_id': self.tag_ids[rank]})
+                    deltas[self.tag_ids[rank]] = deltas.get(self.tag_ids[rank], 0) + 1
+            if links:
+                db.session.execute(tags.insert(), links)
+            update_tag_counts(db.session.connection(), deltas)
+            db.session.commit()
+            self.post_ids.extend(ids)
+            self.post_dates.extend(row['publish_date'] for row in batch)
+        return self.posts
+
+    def comment_date(self, row):
+        """
+        Returns:
+        - datetime: The date of a generated comment, between its post's
+          publish date and END, naive UTC.
+        """
+        published = self.post_dates[row['post']]
+        return published + (END.replace(tzinfo=None) - published) * row['delay']
+
+    def generate_comments(self):
+        if not self.post_ids or not self.user_ids:
+            return 0
+        table = Comment.__table__
+        for batch in self.batches('comments', self.comments):
+            db.session.execute(table.insert(), [{
+                'name': self.usernames[row['user']],
+                'text': row['text'],
+                'text_plain': row['text_plain'],
+                'date': self.comment_date(row),
+                'user_id': self.user_ids[row['user']],
+                'post_id': self.post_ids[row['post']],
+            } for row in batch])
+            touch_posts(db.session.connection(), {self.post_ids[row['post']] for row in batch})
+            db.session.commit()
+        return self.comments